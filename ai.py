@@ -0,0 +1,261 @@
+from cards import best_set, encode as encode_card
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from engine import roll_dice
+from game_state import GameState
+from maps import TOPOLOGY
+from strategies import STRATEGIES, play_pregame_turn
+import asyncio
+import math
+import multiprocessing
+import os
+import random as r
+import signal
+import time
+
+# Computer-controlled players. Each turn, a planner picks how to play it: it tries out a set of candidate
+# policies by playing the rest of the turn and a few more rounds from the current state many times over,
+# with UCB1 deciding which candidate gets the next rollout, until its time is up. The bot then plays the
+# turn one command at a time, asking the chosen policy for the next command given the real game (dice
+# and all) and handing it in through the same validation as a person's commands.
+
+# Seconds of planning per turn for each level; easy players don't plan at all and just play a random policy
+LEVELS = {"easy" : 0.0, "normal" : 1.0, "hard" : 3.0}
+
+# Rounds of every player's turns played out after the planned turn, before scoring the result
+ROLLOUT_ROUNDS = 2
+
+# Most commands a player can take in a turn before something is assumed to have gone wrong
+MAX_COMMANDS = 200
+
+# Most turns computer players take in a row off the back of one person's command, before waiting for another
+MAX_TURNS_PER_COMMAND = 12
+
+# The candidate policies: trading whenever possible or only when forced, stacking every new troop on the
+# strongest frontline territory or reinforcing the weakest, the troop ratio needed to attack, the share of
+# spare troops to move into a conquered territory, and whether to fortify at the end of the turn.
+CANDIDATES = [
+    {"trade" : trade, "stack" : stack, "ratio" : ratio, "advance" : advance, "fortify" : True}
+    for trade in (True, False) for stack in (True, False) for ratio in (1.0, 1.5, 2.5) for advance in (1.0, 0.5)
+]
+DEFAULT_POLICY = {"trade" : True, "stack" : True, "ratio" : 1.5, "advance" : 1.0, "fortify" : True}
+
+# Planning runs in processes of its own, so that it never holds up the event loop, with one per core so that
+# games don't wait on each other's plans
+PLANNERS = os.cpu_count() or 1
+_context = multiprocessing.get_context("spawn")
+_executor = None
+# Where the current planner processes post their pids as they start, so that stuck ones can be killed
+_pids = None
+
+
+def _started(pids) -> None:
+    """Runs in each planner process as it starts."""
+    pids.put(os.getpid())
+
+
+def next_action(state: GameState, seat: int, policy: dict) -> tuple:
+    """Returns what a policy does next on a player's turn, as one of ("trade",), ("deploy", territory, troops),
+    ("blitz", target, attacker), ("advance", troops), ("move", start, destination, troops) and ("endturn",).
+    Pregame deployments are the same for every policy."""
+    if state.in_pregame:
+        probe = state.copy()
+        play_pregame_turn(probe, seat)
+        territory = next(i for i in range(len(state.troops)) if probe.troops[i] != state.troops[i])
+        return ("deploy", territory, 1)
+
+    # Trading and deploying
+    if state.turn_stage == 0:
+        return ("trade",)
+    if state.turn_stage == 1:
+        if policy["trade"] and len(state.cards[seat]) >= 3 and best_set(state.hand(seat), [], state.owned(seat)):
+            return ("trade",)
+        frontline = [i for i in state.territories(seat) if state.enemies(seat, i)]
+        if policy["stack"]:
+            territory = max(frontline, key=lambda i: state.troops[i] - min(state.troops[j] for j in state.enemies(seat, i)))
+        else:
+            territory = min(frontline, key=lambda i: state.troops[i])
+        return ("deploy", territory, state.deployable_troops[seat])
+
+    # Following a conquest forward
+    if state.last_attack is not None and policy["advance"]:
+        target, attacker, _ = state.last_attack
+        if state.owners[target] == seat and state.troops[attacker] > 1:
+            return ("advance", max(1, int((state.troops[attacker] - 1) * policy["advance"])))
+
+    # Attacking wherever the odds are good enough
+    attacks = [
+        (state.troops[attacker] - state.troops[target], target, attacker)
+        for attacker in state.territories(seat) if state.troops[attacker] > 1
+        for target in state.enemies(seat, attacker) if state.troops[attacker] >= policy["ratio"] * state.troops[target] + 1
+    ]
+    if attacks:
+        _, target, attacker = max(attacks)
+        return ("blitz", target, attacker)
+
+    # Fortifying the weakest frontline territory with the biggest army behind the lines
+    if policy["fortify"]:
+        territories = state.territories(seat)
+        interior = [i for i in territories if state.troops[i] > 1 and not state.enemies(seat, i)]
+        if interior:
+            start = max(interior, key=lambda i: state.troops[i])
+            frontline = [i for i in territories if state.enemies(seat, i) and state.has_path(seat, start, i)]
+            if frontline:
+                return ("move", start, min(frontline, key=lambda i: state.troops[i]), state.troops[start] - 1)
+    return ("endturn",)
+
+
+def apply_action(state: GameState, seat: int, action: tuple) -> bool:
+    """Carries out an action on a GameState, rolling dice where needed. Returns whether it won the game."""
+    kind = action[0]
+    if kind == "trade":
+        index = TOPOLOGY[state.map]["index"]
+        state.trade(seat, [encode_card(card, index) for card in best_set(state.hand(seat), [], state.owned(seat))])
+    elif kind == "deploy":
+        state.deploy(seat, action[1], action[2])
+    elif kind == "blitz":
+        _, target, attacker = action
+        while True:
+            army_size = min(3, state.troops[attacker] - 1)
+            result = state.attack(seat, target, attacker, army_size, *roll_dice(army_size, state.troops[target]))
+            if result["victory"]:
+                return True
+            if result["conquered"] or state.troops[attacker] == 1:
+                break
+    elif kind == "advance":
+        state.advance(action[1])
+    elif kind == "move":
+        state.move(action[1], action[2], action[3])
+    else:
+        state.end_turn()
+    return False
+
+
+def command(state: GameState, action: tuple) -> str:
+    """Writes an action out as the command a person would type for it."""
+    names = TOPOLOGY[state.map]["names"]
+    kind = action[0]
+    if kind == "deploy":
+        return f"!deploy {action[2]} {names[action[1]]}"
+    if kind == "blitz":
+        return f"!blitz {names[action[1]]} from {names[action[2]]}"
+    if kind == "advance":
+        return f"!move {action[1]}"
+    if kind == "move":
+        return f"!move {action[3]} from {names[action[1]]} to {names[action[2]]}"
+    return f"!{kind}"
+
+
+def next_command(game: dict, policy: dict) -> str:
+    """Returns the command a policy gives next for the player whose turn it is in a game."""
+    state = GameState.from_game(game)
+    return command(state, next_action(state, state.active_player, policy))
+
+
+def _play_turn(state: GameState, seat: int, policy: dict) -> bool:
+    """Plays out a player's turn with a policy. Returns whether it won the game."""
+    for _ in range(MAX_COMMANDS):
+        if state.active_player != seat or state.in_pregame:
+            break
+        if apply_action(state, seat, next_action(state, seat, policy)):
+            return True
+    return False
+
+
+def _score(state: GameState, seat: int) -> float:
+    """Rates a player's position between 0 and 1, by their shares of the troops on the board and of the troops
+    everyone still in the game would get next turn."""
+    alive = [other for other in range(len(state.player_ids)) if other not in state.eliminated_players]
+    troops = [0] * len(state.player_ids)
+    for owner, count in zip(state.owners, state.troops):
+        if owner >= 0:
+            troops[owner] += count
+    income = {other : state.calculate_new_troops(other) for other in alive}
+    return 0.5 * troops[seat] / sum(troops) + 0.5 * income[seat] / sum(income.values())
+
+
+def _rollout(state: GameState, seat: int, policy: dict) -> float:
+    """Plays a turn with a policy and ROLLOUT_ROUNDS more rounds after it (with the aggressive strategy for
+    everyone else), then scores the player's position: 1 for winning, 0 for losing."""
+    if _play_turn(state, seat, policy):
+        return 1.0
+    for _ in range(ROLLOUT_ROUNDS * len(state.player_ids)):
+        other = state.active_player
+        if other == seat:
+            if _play_turn(state, seat, policy):
+                return 1.0
+        elif STRATEGIES["aggressive"](state, other):
+            return 0.0
+        if seat in state.eliminated_players:
+            return 0.0
+    return _score(state, seat)
+
+
+def plan(game: dict, level: str, deadline: float = None) -> dict:
+    """Picks a policy for the turn of the player whose turn it is, within the level's time budget, and by the
+    time.time() deadline if one is given (so that a plan that spent a while queued doesn't make up for it)."""
+    budget = LEVELS[level]
+    if not budget or game["in_pregame"]:
+        return r.choice(CANDIDATES) if budget == 0 else DEFAULT_POLICY
+    deadline = min(time.time() + budget, deadline or float("inf"))
+    state = GameState.from_game(game)
+    seat = state.active_player
+
+    visits, totals = [0] * len(CANDIDATES), [0.0] * len(CANDIDATES)
+    rollouts = 0
+    while time.time() < deadline:
+        if rollouts < len(CANDIDATES):
+            i = rollouts
+        else:
+            i = max(
+                range(len(CANDIDATES)),
+                key=lambda i: totals[i] / visits[i] + 0.3 * math.sqrt(math.log(rollouts) / visits[i])
+            )
+        totals[i] += _rollout(state.copy(), seat, CANDIDATES[i])
+        visits[i] += 1
+        rollouts += 1
+    if not rollouts:
+        return DEFAULT_POLICY
+    return CANDIDATES[max(range(len(CANDIDATES)), key=lambda i: (visits[i], totals[i]))]
+
+
+async def plan_turn(game: dict, level: str) -> dict:
+    """Awaitable version of plan, run in a planner process. Falls back to DEFAULT_POLICY if planning goes well
+    over its time or the processes die."""
+    global _executor, _pids
+    if _executor is None:
+        _pids = _context.SimpleQueue()
+        _executor = ProcessPoolExecutor(max_workers=PLANNERS, mp_context=_context, initializer=_started, initargs=(_pids,))
+    executor, pids = _executor, _pids
+    loop = asyncio.get_running_loop()
+    try:
+        return await asyncio.wait_for(
+            loop.run_in_executor(executor, plan, game, level, time.time() + LEVELS[level]), LEVELS[level] + 10
+        )
+    except asyncio.TimeoutError:
+        # A planner is stuck: its processes are killed and the plans queued behind it dropped, rather than left to
+        # pile up, and the next plan starts a fresh set
+        if executor is _executor:
+            _executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+            while not pids.empty():
+                try:
+                    os.kill(pids.get(), signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+        return DEFAULT_POLICY
+    except BrokenProcessPool:
+        if executor is _executor:
+            _executor = None
+        return DEFAULT_POLICY
+    except asyncio.CancelledError:
+        # Plans dropped by another plan's timeout fall back too; anything else cancelling this one carries on
+        if executor is _executor:
+            raise
+        return DEFAULT_POLICY
+
+
+def shutdown() -> None:
+    """Stops the planner processes."""
+    if _executor is not None:
+        _executor.shutdown()
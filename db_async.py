@@ -0,0 +1,287 @@
+import asyncio
+import db_connector
+import game_cache
+import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from copy import deepcopy
+from functools import partial, wraps
+
+# All writes happen on this one thread, so slow commits never hold up the event loop.
+# A single worker keeps the writer connection from ever being used by two threads at once.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+# Reads go to a pool of threads with a read-only connection each, so they can run alongside writes and each other
+READERS = 4
+_readers = ThreadPoolExecutor(max_workers=READERS, thread_name_prefix="db-read", initializer=db_connector.open_reader)
+
+# Seconds between background writes of games that have changed
+FLUSH_INTERVAL = 30
+
+
+async def _run(func, *args):
+    """Runs a blocking db_connector function on the database thread and waits for its result."""
+    return await asyncio.get_running_loop().run_in_executor(_executor, partial(func, *args))
+
+
+async def _read(func, *args):
+    """Runs a read-only db_connector function on one of the reader threads and waits for its result."""
+    return await asyncio.get_running_loop().run_in_executor(_readers, partial(func, *args))
+
+
+def _awaitable(func, read_only: bool = False):
+    """Turns a db_connector function into a coroutine function with the same signature."""
+    @wraps(func)
+    async def wrapper(*args):
+        return await (_read if read_only else _run)(func, *args)
+    return wrapper
+
+
+def _deferrable(func):
+    """Like _awaitable, but inside a unit of work the write is queued and a Pending result is returned instead."""
+    @wraps(func)
+    async def wrapper(*args):
+        work = _unit_of_work.get()
+        if work is None:
+            return await _run(func, *args)
+        result = Pending()
+        work.append((func, args, result))
+        return result
+    return wrapper
+
+
+class Pending:
+    """Stands in for the result of a queued write until its unit of work is committed.
+    Passing one to another queued write hands that write the real result."""
+    value = None
+
+
+# The writes queued by the unit of work of the command currently being handled, if there is one
+_unit_of_work = ContextVar("unit_of_work", default=None)
+
+# How many units of work that haven't finished have read each game, by game id. Commands change the cached
+# game in place before they update it, so flushes leave these games alone until they're done.
+_in_use = {}
+
+
+@asynccontextmanager
+async def unit_of_work():
+    """Queues every write made inside the block, then commits them all at once when it exits.
+    If the block or the commit raises, nothing is written, and every game it read is put back the way it was."""
+    if _unit_of_work.get() is not None:
+        yield
+        return
+    work = []
+    token = _unit_of_work.set(work)
+    try:
+        try:
+            yield
+        finally:
+            _unit_of_work.reset(token)
+        await _commit(work)
+    except BaseException:
+        await _roll_back(work)
+        raise
+    finally:
+        for entry in work:
+            if entry[0] == "read":
+                _in_use[entry[1]] -= 1
+                if not _in_use[entry[1]]:
+                    del _in_use[entry[1]]
+
+
+async def _roll_back(work: list) -> None:
+    """Puts every game a failed unit of work read back the way it was. Games that had no unwritten changes can
+    simply be re-read; the others go back to their copy from before."""
+    for game_id, backup in [entry[1:] for entry in work if entry[0] == "read"]:
+        if backup is None:
+            game_cache.discard(game_id)
+        else:
+            await _write(game_cache.put(game_id, backup, dirty=True))
+
+
+async def _commit(work: list) -> None:
+    """Carries out a unit of work's queued writes in one transaction, then its cache updates, so that the cache
+    is only touched once the writes have stuck. Checkpointed games are written in the transaction; dirty games
+    evicted to make room are written after it."""
+    operations = []
+    for entry in work:
+        if entry[0] == "read":
+            continue
+        if entry[0] == "update":
+            _, game_id, game, checkpoint = entry
+            if checkpoint:
+                operations.append((db_connector.update_encoded_game, (game_id, db_connector.encode_game(game)), Pending()))
+        else:
+            operations.append(entry)
+    if operations:
+        await _run(_apply, operations)
+
+    evicted = []
+    for entry in work:
+        if entry[0] == "update":
+            _, game_id, game, checkpoint = entry
+            evicted += game_cache.put(game_id, game, dirty=True)
+            if checkpoint:
+                game_cache.mark_clean(game_id, game)
+        elif entry[0] == db_connector.delete_game:
+            game_cache.discard(entry[1][0])
+            _writing.pop(entry[1][0], None)
+    await _write(evicted)
+
+
+def _apply(operations: list) -> None:
+    """Runs queued writes in one transaction. Runs on the database thread."""
+    with db_connector.transaction():
+        for func, args, result in operations:
+            result.value = func(*[arg.value if isinstance(arg, Pending) else arg for arg in args])
+
+
+ensure_user_exists = _deferrable(db_connector.ensure_user_exists)
+create_game = _deferrable(db_connector.create_game)
+get_user_game_id = _awaitable(db_connector.get_user_game_id, read_only=True)
+update_user_game_pointer = _deferrable(db_connector.update_user_game_pointer)
+clear_game_pointers = _deferrable(db_connector.clear_game_pointers)
+get_game_members = _awaitable(db_connector.get_game_members, read_only=True)
+increment_rigged_counter = _awaitable(db_connector.increment_rigged_counter)
+append_event = _deferrable(db_connector.append_event)
+save_snapshot = _deferrable(db_connector.save_snapshot)
+get_game_events = _awaitable(db_connector.get_game_events, read_only=True)
+replay_game = _awaitable(db_connector.replay_game, read_only=True)
+
+
+def _replay_history(game_id: int, game: dict, func):
+    return func(game, db_connector.iter_game_events(game_id, after=game["event_count"]))
+
+
+async def replay_history(game_id: int, game: dict, func):
+    """Calls func(game, events) on a reader thread and returns its result, where game is a copy of the game
+    from replay_game and events iterates over the game's logged events after it, fetched as they're needed."""
+    return await _read(_replay_history, game_id, game, func)
+
+
+# Game data goes through game_cache: reads are served from memory when possible and writes are
+# only marked dirty, reaching sqlite on a checkpoint, a periodic flush, eviction or shutdown.
+
+# Reads of games that missed the cache and are still on their way, by game id; everyone after the same game
+# waits on the one read, so that only one copy of a game ever makes it into the cache
+_loading = {}
+
+# Games that have left the cache but whose latest changes are still on their way to the database, by game id.
+# A reader connection would only see the older copy that's been committed, so these are picked up from here.
+_writing = {}
+
+async def get_game_data(game_id: int) -> dict:
+    """Returns a game's data, or None if there is no such game."""
+    if game_id is None:
+        return None
+    game = game_cache.get(game_id)
+    if game is None:
+        if game_id not in _loading:
+            _loading[game_id] = asyncio.ensure_future(_load(game_id))
+        game = await asyncio.shield(_loading[game_id])
+    # A unit of work keeps a copy of each game with unwritten changes that it reads, from before it can change it
+    work = _unit_of_work.get()
+    if work is not None and game is not None and not any(entry[:2] == ("read", game_id) for entry in work):
+        work.append(("read", game_id, deepcopy(game) if game_cache.is_dirty(game_id) else None))
+        _in_use[game_id] = _in_use.get(game_id, 0) + 1
+    return game
+
+
+async def _load(game_id: int) -> dict:
+    """Reads a game into the cache and returns it, or None if there is no such game."""
+    try:
+        game = _writing.get(game_id)
+        if game is not None:
+            await _write(game_cache.put(game_id, game, dirty=True))
+            return game
+        game = await _read(db_connector.get_game_data, game_id)
+        if game is not None:
+            await _write(game_cache.put(game_id, game))
+        return game
+    finally:
+        del _loading[game_id]
+
+
+async def get_user_game_data(user_id: int, guild_id: int) -> dict:
+    """Returns the game data that a user/guild pair points to, or None if there is no game."""
+    return await get_game_data(await get_user_game_id(user_id, guild_id))
+
+
+async def update_game(game_id: int, game_data: dict, checkpoint: bool = False, event: tuple[str, dict] = None) -> None:
+    """Updates game data. The write is deferred unless this is a checkpoint, such as the end of a turn.
+    The (command, payload) event that brought about the update, if given, is logged straight away."""
+    if event is not None:
+        command, payload = event
+        seq = game_data.get("event_count", -1) + 1
+        game_data["event_count"] = seq
+        await append_event(game_id, seq, command, json.dumps(payload))
+        if seq % db_connector.SNAPSHOT_INTERVAL == 0:
+            await save_snapshot(game_id, seq, db_connector.encode_snapshot(game_data))
+    work = _unit_of_work.get()
+    if work is not None:
+        work.append(("update", game_id, game_data, checkpoint))
+        return
+    await _write(game_cache.put(game_id, game_data, dirty=True))
+    if checkpoint:
+        await _write([(game_id, game_data)])
+
+
+async def update_user_game_data(user_id: int, guild_id: int, game_data: dict, checkpoint: bool = False, event: tuple[str, dict] = None) -> None:
+    """Updates the data of the user's current game. See update_game for when the write happens."""
+    game_id = await get_user_game_id(user_id, guild_id)
+    if game_id is not None:
+        await update_game(game_id, game_data, checkpoint, event)
+
+
+async def delete_game(game_id: int) -> None:
+    """Removes game from the cache and the database."""
+    work = _unit_of_work.get()
+    if work is not None:
+        work.append((db_connector.delete_game, (game_id,), Pending()))
+        return
+    game_cache.discard(game_id)
+    _writing.pop(game_id, None)
+    await _run(db_connector.delete_game, game_id)
+
+
+async def _write(games: list[tuple[int, dict]]) -> None:
+    """Writes games to the database, encoding them here so they can't change mid-write."""
+    for game_id, game in games:
+        _writing[game_id] = game
+    for i, (game_id, game) in enumerate(games):
+        try:
+            await _run(db_connector.update_encoded_game, game_id, db_connector.encode_game(game))
+        except BaseException:
+            _written(games[i:])
+            raise
+        _written([(game_id, game)])
+        game_cache.mark_clean(game_id, game)
+
+
+def _written(games: list[tuple[int, dict]]) -> None:
+    """Takes games out of _writing once their writes are over, unless a newer copy has been queued since."""
+    for game_id, game in games:
+        if _writing.get(game_id) is game:
+            del _writing[game_id]
+
+
+async def flush() -> None:
+    """Writes every game with unwritten changes and evicts the games nobody has touched in a while. Games that a
+    command is in the middle of changing are left for the next flush, so that no half-done command is written."""
+    await _write([(game_id, game) for game_id, game in game_cache.dirty_games() if game_id not in _in_use])
+    await _write(game_cache.evict_idle())
+
+
+async def flush_periodically() -> None:
+    """Flushes the cache every FLUSH_INTERVAL seconds until cancelled."""
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await flush()
+
+
+def shutdown() -> None:
+    """Waits for any queued database work to finish and stops the database threads."""
+    _readers.shutdown(wait=True)
+    _executor.shutdown(wait=True)
@@ -1,26 +1,225 @@
 import sqlite3 as sql
+import engine
+import game_codec
 import json
+import os
+import threading
+from contextlib import contextmanager
 
-db = sql.connect("risk.db")
+DATABASE = "risk.db"
+
+# How hard sqlite works to make sure a commit survives a crash. In WAL mode, FULL also survives power loss,
+# NORMAL can lose the last few commits to a power loss (but never corrupts anything), and OFF leaves it to the OS.
+SYNCHRONOUS = os.environ.get("RISK_DB_SYNCHRONOUS", "NORMAL").upper()
+
+# How many prepared statements each connection keeps around for reuse
+STATEMENT_CACHE_SIZE = 256
+
+def _open(read_only: bool = False) -> sql.Connection:
+    """Opens a connection to the database, either the writer (which puts the database in WAL mode) or a reader."""
+    if SYNCHRONOUS not in ("FULL", "NORMAL", "OFF"):
+        raise ValueError(f"Unknown synchronous level '{SYNCHRONOUS}'; expected FULL, NORMAL or OFF.")
+    # check_same_thread is off because db_async hands connections to its own worker threads
+    connection = sql.connect(
+        f"file:{DATABASE}?mode={'ro' if read_only else 'rwc'}",
+        uri=True,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE
+    )
+    if not read_only:
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute(f"PRAGMA synchronous = {SYNCHRONOUS}")
+    return connection
+
+# The one connection that writes; with WAL, readers aren't blocked while it commits
+db = _open()
 cursor = db.cursor()
 
+# Read-only connections, one per thread that opened one; other threads read through the writer
+_readers = threading.local()
+
+def open_reader() -> None:
+    """Gives the calling thread its own read-only connection to do its reads with."""
+    _readers.cursor = _open(read_only=True).cursor()
+
+def _read_cursor() -> sql.Cursor:
+    """Returns the calling thread's read-only cursor, or the writer's cursor if it doesn't have one."""
+    return getattr(_readers, "cursor", cursor)
+
+# How running games are stored: "binary" keeps each game as one game_codec-encoded game_data value, "json" as
+# one JSON string, and "rows" keeps territories, players and cards in their own tables so that a write only
+# touches the rows that changed. Games waiting on invites are always stored as JSON, and every kind of stored
+# game can be read whatever this is set to.
+GAME_STORAGE = "binary"
+
+# Every command that changes a running game is appended to game_events; every this many events, a snapshot of the
+# whole game is saved too, so that any point of the game can be rebuilt without replaying it from the start
+SNAPSHOT_INTERVAL = 50
+
+# The row-storage tables, as (key columns, value columns); every table is also keyed by game_id
+ROW_TABLES = {
+    "territories" : (("name",), ("owner", "troops", "position")),
+    "players" : (("player_id",), ("turn_number", "colour", "deployable_troops", "eliminated")),
+    "cards" : (("location", "slot"), ("type", "territory"))
+}
+
+# The select, upsert and delete statements for each row-storage table, built once so they're always the same string
+_ROW_STATEMENTS = {
+    table : (
+        f"SELECT {', '.join(key_columns + value_columns)} FROM {table} WHERE game_id = ?",
+        f"INSERT INTO {table} (game_id, {', '.join(key_columns + value_columns)}) VALUES ({', '.join('?' * (len(key_columns + value_columns)+1))}) "
+        f"ON CONFLICT DO UPDATE SET {', '.join(f'{column} = excluded.{column}' for column in value_columns)}",
+        f"DELETE FROM {table} WHERE game_id = ? AND {' AND '.join(f'{column} = ?' for column in key_columns)}"
+    )
+    for table, (key_columns, value_columns) in ROW_TABLES.items()
+}
+
+# The rows last written for each row-storage game, as encode_game made them, so that the next write can tell what
+# changed without reading them back. Only the database thread touches this.
+_stored_rows = {}
+
+# While this is above zero, writes are left uncommitted so that they can all be committed together
+_transaction_depth = 0
+
+def _commit() -> None:
+    """Commits the current write, unless it's part of a larger transaction."""
+    if not _transaction_depth:
+        db.commit()
+
+@contextmanager
+def transaction():
+    """Groups every write made inside the block into one commit, rolling them all back if anything fails."""
+    global _transaction_depth
+    _transaction_depth += 1
+    try:
+        yield
+    except BaseException:
+        _transaction_depth -= 1
+        if not _transaction_depth:
+            db.rollback()
+            # Whatever was written in the transaction is gone again, so the rows have to be read back next time
+            _stored_rows.clear()
+        raise
+    _transaction_depth -= 1
+    if not _transaction_depth:
+        db.commit()
+
 def ensure_user_exists(user_id: int, guild_id: int) -> None:
     """Adds a user/guild pair to the roster; users have a unique game pointer for every guild."""
     try:
         cursor.execute("INSERT INTO users (user_id, guild_id, game_id) VALUES (?, ?, NULL)", (user_id, guild_id))
-        db.commit()
+        _commit()
     except sql.IntegrityError:
         pass
 
 def create_game(game_data: dict) -> int:
-    """Creates game with data in provided dictionary and returns the database-generated game id."""
-    cursor.execute("INSERT INTO games (game_data) VALUES (?)", (json.dumps(game_data),))
-    db.commit()
-    cursor.execute("SELECT MAX(game_id) FROM games")
-    return cursor.fetchone()[0]
+    """Creates game with data in provided dictionary and returns the database-generated game id. Ids are never
+    reused, not even those of deleted games, since a finished game's events and snapshots outlive it."""
+    cursor.execute(
+        """INSERT INTO games (game_id, game_data) VALUES (1 + MAX(
+            (SELECT IFNULL(MAX(game_id), 0) FROM games),
+            (SELECT IFNULL(MAX(game_id), 0) FROM game_events),
+            (SELECT IFNULL(MAX(game_id), 0) FROM game_snapshots)
+        ), ?)""",
+        (encode_game(game_data),)
+    )
+    game_id = cursor.lastrowid
+    _commit()
+    return game_id
+
+def encode_game(game_data: dict):
+    """Serializes game data into the form it's stored in: bytes, a JSON string, or with row storage, a tuple
+    of the remaining game variables and a {key : values} dict for each of the ROW_TABLES."""
+    if GAME_STORAGE == "binary" and game_codec.can_encode(game_data):
+        return game_codec.encode(game_data)
+    if GAME_STORAGE != "rows" or "territories" not in game_data:
+        return json.dumps(game_data)
+
+    meta = {key : value for key, value in game_data.items() if key not in ("players", "territories", "deck", "discard_pile")}
+    # Each territory's place in its owner's list of territories, so that the lists come back in the same order
+    positions = {name : i for p_data in game_data["players"].values() for i, name in enumerate(p_data["territories"])}
+    territories = {
+        (name,) : (None if t_data["owner"] is None else int(t_data["owner"]), t_data["troops"], positions.get(name))
+        for name, t_data in game_data["territories"].items()
+    }
+    players = {
+        (int(player_id),) : (p_data["turn_number"], p_data["colour"], p_data["deployable_troops"], p_data["cards"] is None)
+        for player_id, p_data in game_data["players"].items()
+    }
+    piles = [("deck", game_data["deck"]), ("discard", game_data["discard_pile"])]
+    piles += [(player_id, p_data["cards"] or []) for player_id, p_data in game_data["players"].items()]
+    cards = {
+        (location, slot) : tuple(card)
+        for location, pile in piles for slot, card in enumerate(pile)
+    }
+    return (json.dumps(meta), territories, players, cards)
+
+def decode_game(data, game_id: int = None) -> dict:
+    """Deserializes stored game data, pulling in the game's rows if it was stored with row storage."""
+    if isinstance(data, bytes):
+        return game_codec.decode(data)
+    game_data = json.loads(data)
+    if "territories" not in game_data and game_data.get("active") and game_id is not None:
+        _load_game_rows(game_id, game_data)
+    return game_data
+
+def _load_game_rows(game_id: int, game_data: dict) -> None:
+    """Fills in the parts of a game that row storage keeps outside the game_data column."""
+    cursor = _read_cursor()
+    game_data["players"] = {}
+    cursor.execute("SELECT player_id, colour, deployable_troops, eliminated FROM players WHERE game_id = ? ORDER BY turn_number", (game_id,))
+    for i, (player_id, colour, deployable_troops, eliminated) in enumerate(cursor.fetchall()):
+        game_data["players"][str(player_id)] = {
+            "turn_number" : i+1,
+            "colour" : colour,
+            "territories" : [],
+            "cards" : None if eliminated else [],
+            "deployable_troops" : deployable_troops
+        }
+
+    game_data["territories"] = {}
+    cursor.execute("SELECT name, owner, troops FROM territories WHERE game_id = ? ORDER BY position", (game_id,))
+    for name, owner, troops in cursor.fetchall():
+        owner = None if owner is None else str(owner)
+        game_data["territories"][name] = {"owner" : owner, "troops" : troops}
+        if owner is not None:
+            game_data["players"][owner]["territories"].append(name)
+
+    game_data["deck"], game_data["discard_pile"] = [], []
+    cursor.execute("SELECT location, type, territory FROM cards WHERE game_id = ? ORDER BY location, slot", (game_id,))
+    for location, card_type, territory in cursor.fetchall():
+        if location == "deck":
+            game_data["deck"].append((card_type, territory))
+        elif location == "discard":
+            game_data["discard_pile"].append((card_type, territory))
+        else:
+            game_data["players"][location]["cards"].append((card_type, territory))
+
+def _write_game_rows(game_id: int, data: tuple) -> None:
+    """Writes a row-storage encoding of a game, only touching the rows that differ from the ones last written.
+    Those are only read from the database the first time a game is written since the bot started."""
+    meta, *tables = data
+    cursor.execute("UPDATE games SET game_data = ? WHERE game_id = ?", (meta, game_id))
+    last_written = _stored_rows.get(game_id)
+    for i, ((table, (key_columns, _)), rows) in enumerate(zip(ROW_TABLES.items(), tables)):
+        select, upsert, delete = _ROW_STATEMENTS[table]
+        if last_written is None:
+            cursor.execute(select, (game_id,))
+            stored = {row[:len(key_columns)] : row[len(key_columns):] for row in cursor.fetchall()}
+        else:
+            stored = last_written[i]
+
+        changed = [(game_id,) + key + values for key, values in rows.items() if stored.get(key) != values]
+        if changed:
+            cursor.executemany(upsert, changed)
+        removed = [(game_id,) + key for key in stored.keys() - rows.keys()]
+        if removed:
+            cursor.executemany(delete, removed)
+    _stored_rows[game_id] = tables
 
 def get_user_game_id(user_id: int, guild_id: int) -> int:
     """Returns the id of a user's game or None if there is no game."""
+    cursor = _read_cursor()
     cursor.execute("SELECT game_id FROM users WHERE user_id = ? AND guild_id = ?", (user_id, guild_id))
     id = cursor.fetchone()
     if id != None:
@@ -29,35 +228,123 @@ def get_user_game_id(user_id: int, guild_id: int) -> int:
 
 def get_user_game_data(user_id: int, guild_id: int) -> dict:
     """Returns the de-jsonified game data that a user/guild pair points to, or None if there is no game."""
-    cursor.execute("SELECT game_data FROM games WHERE game_id = (SELECT game_id FROM users WHERE user_id = ? AND guild_id = ?)", (user_id, guild_id))
+    return get_game_data(get_user_game_id(user_id, guild_id))
+
+def get_game_data(game_id: int) -> dict:
+    """Returns the de-jsonified data of a game, or None if there is no such game."""
+    cursor = _read_cursor()
+    cursor.execute("SELECT game_data FROM games WHERE game_id = ?", (game_id,))
     data = cursor.fetchone()
     if data != None:
-        data = json.loads(data[0])
+        data = decode_game(data[0], game_id)
+        # The stored game may be older than the event log if it was last written before a crash
+        for seq, command, payload in get_game_events(game_id, after=data.get("event_count", -1)):
+            engine.apply_event(data, command, payload)
+            data["event_count"] = seq
     return data
 
 def update_user_game_pointer(user_id: int, guild_id: int, game_id: int) -> None:
-    """Changes a user's game id pointer or sets it to null."""
-    cursor.execute("UPDATE users SET game_id = ? WHERE user_id = ? AND guild_id = ?", (game_id, user_id, guild_id))
-    db.commit()
+    """Changes a user's game id pointer or sets it to null. Computer players (the users with negative ids) only
+    ever play the one game, so instead of being left with a null pointer they're taken off the roster."""
+    if game_id is None and int(user_id) < 0:
+        cursor.execute("DELETE FROM users WHERE user_id = ? AND guild_id = ?", (user_id, guild_id))
+    else:
+        cursor.execute("UPDATE users SET game_id = ? WHERE user_id = ? AND guild_id = ?", (game_id, user_id, guild_id))
+    _commit()
+
+def get_game_members(game_id: int) -> list[int]:
+    """Returns the ids of the users whose game pointer points to a game."""
+    cursor = _read_cursor()
+    cursor.execute("SELECT user_id FROM users WHERE game_id = ?", (game_id,))
+    return [user_id for (user_id,) in cursor.fetchall()]
+
+def clear_game_pointers(game_id: int) -> None:
+    """Sets the game pointer of every user in a game to null, and takes its computer players off the roster."""
+    cursor.execute("DELETE FROM users WHERE game_id = ? AND user_id < 0", (game_id,))
+    cursor.execute("UPDATE users SET game_id = NULL WHERE game_id = ?", (game_id,))
+    _commit()
 
 def update_user_game_data(user_id: int, guild_id: int, game_data: dict) -> None:
     """Updates the data of the user's current game."""
-    cursor.execute("UPDATE games SET game_data = ? WHERE game_id = (SELECT game_id FROM users WHERE user_id = ? AND guild_id = ?)", (json.dumps(game_data), user_id, guild_id))
-    db.commit()
+    game_id = get_user_game_id(user_id, guild_id)
+    if game_id is not None:
+        update_game(game_id, game_data)
 
 def update_game(game_id: int, game_data: dict) -> None:
     """Updates game data."""
-    cursor.execute("UPDATE games SET game_data = ? WHERE ROWID = ?", (json.dumps(game_data), game_id))
-    db.commit()
+    update_encoded_game(game_id, encode_game(game_data))
+
+def update_encoded_game(game_id: int, data) -> None:
+    """Updates game data that has already been through encode_game."""
+    if isinstance(data, tuple):
+        _write_game_rows(game_id, data)
+    else:
+        cursor.execute("UPDATE games SET game_data = ? WHERE ROWID = ?", (data, game_id))
+    _commit()
 
 def delete_game(game_id: int) -> None:
-    """Removes game from database."""
+    """Removes game from database. Its events and snapshots are kept as a record of the game."""
     cursor.execute("DELETE FROM games WHERE ROWID = ?", (game_id,))
-    db.commit()
+    _stored_rows.pop(game_id, None)
+    for table in ROW_TABLES:
+        cursor.execute(f"DELETE FROM {table} WHERE game_id = ?", (game_id,))
+    _commit()
+
+def encode_snapshot(game_data: dict):
+    """Serializes game data for the game_snapshots table, which always holds whole games."""
+    if game_codec.can_encode(game_data):
+        return game_codec.encode(game_data)
+    return json.dumps(game_data)
+
+def append_event(game_id: int, seq: int, command: str, payload: str) -> None:
+    """Logs a command (with its JSON-encoded arguments and dice) as a game's seq-th event."""
+    cursor.execute("INSERT INTO game_events (game_id, seq, command, payload) VALUES (?, ?, ?, ?)", (game_id, seq, command, payload))
+    _commit()
+
+def save_snapshot(game_id: int, seq: int, data) -> None:
+    """Saves a game as it was right after its seq-th event; data must have been through encode_snapshot."""
+    cursor.execute("INSERT OR REPLACE INTO game_snapshots (game_id, seq, game_data) VALUES (?, ?, ?)", (game_id, seq, data))
+    _commit()
+
+def iter_game_events(game_id: int, after: int = -1, upto: int = None):
+    """Yields a game's logged events as (seq, command, payload) tuples, oldest first, optionally limited to a range.
+    The rows are fetched as they're needed, on a cursor of their own, so a long history never sits in memory at once."""
+    events = _read_cursor().connection.execute(
+        "SELECT seq, command, payload FROM game_events WHERE game_id = ? AND seq > ? AND seq <= ? ORDER BY seq",
+        (game_id, after, upto if upto is not None else 2**62)
+    )
+    try:
+        for seq, command, payload in events:
+            yield seq, command, json.loads(payload)
+    finally:
+        events.close()
+
+def get_game_events(game_id: int, after: int = -1, upto: int = None) -> list[tuple[int, str, dict]]:
+    """Returns a game's logged events as (seq, command, payload) tuples, oldest first, optionally limited to a range."""
+    return list(iter_game_events(game_id, after, upto))
+
+def replay_game(game_id: int, seq: int = None) -> dict:
+    """Rebuilds a game as it was right after its seq-th event (or its latest) from the nearest snapshot and the
+    events after it. Works for finished games too, since their history outlives them. Returns None if there's
+    no snapshot to start from."""
+    cursor = _read_cursor()
+    cursor.execute(
+        "SELECT seq, game_data FROM game_snapshots WHERE game_id = ? AND seq <= ? ORDER BY seq DESC LIMIT 1",
+        (game_id, seq if seq is not None else 2**62)
+    )
+    snapshot = cursor.fetchone()
+    if snapshot is None:
+        return None
+    game_data = decode_game(snapshot[1])
+    game_data["event_count"] = snapshot[0]
+    for event_seq, command, payload in iter_game_events(game_id, after=snapshot[0], upto=seq):
+        engine.apply_event(game_data, command, payload)
+        game_data["event_count"] = event_seq
+    return game_data
 
 def increment_rigged_counter() -> int:
     """Adds 1 to the rigged counter and returns the new rigged count."""
     cursor.execute("UPDATE rigged SET count = count + 1")
-    db.commit()
+    _commit()
     cursor.execute("SELECT count FROM rigged")
     return cursor.fetchone()[0]
\ No newline at end of file
@@ -5,7 +5,7 @@ cur = con.cursor()
 
 cur.execute(
     """
-    CREATE TABLE users (
+    CREATE TABLE IF NOT EXISTS users (
         user_id INTEGER NOT NULL,
         guild_id INTEGER NOT NULL,
         game_id INTEGER,
@@ -15,22 +15,98 @@ cur.execute(
 )
 cur.execute(
     """
-    CREATE TABLE games (
+    CREATE TABLE IF NOT EXISTS games (
         game_id INTEGER NOT NULL PRIMARY KEY,
-        game_data TEXT NOT NULL
+        game_data BLOB NOT NULL
     );
     """
 )
+# For finding (and clearing) everyone in a game without decoding it
 cur.execute(
     """
-    CREATE TABLE rigged (
+    CREATE INDEX IF NOT EXISTS users_by_game ON users (game_id);
+    """
+)
+# Tables used by db_connector's row storage, which keeps a game's pieces outside of games.game_data
+cur.execute(
+    """
+    CREATE TABLE IF NOT EXISTS territories (
+        game_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        owner INTEGER,
+        troops INTEGER NOT NULL,
+        position INTEGER,
+        PRIMARY KEY (game_id, name)
+    ) WITHOUT ROWID;
+    """
+)
+# Databases made before territories had a position (their place in the owner's list of territories) get one
+if "position" not in [column[1] for column in cur.execute("PRAGMA table_info(territories)")]:
+    cur.execute("ALTER TABLE territories ADD COLUMN position INTEGER")
+cur.execute(
+    """
+    CREATE TABLE IF NOT EXISTS players (
+        game_id INTEGER NOT NULL,
+        player_id INTEGER NOT NULL,
+        turn_number INTEGER NOT NULL,
+        colour TEXT NOT NULL,
+        deployable_troops INTEGER NOT NULL,
+        eliminated INTEGER NOT NULL,
+        PRIMARY KEY (game_id, player_id)
+    ) WITHOUT ROWID;
+    """
+)
+cur.execute(
+    """
+    CREATE TABLE IF NOT EXISTS cards (
+        game_id INTEGER NOT NULL,
+        location TEXT NOT NULL,
+        slot INTEGER NOT NULL,
+        type TEXT NOT NULL,
+        territory TEXT,
+        PRIMARY KEY (game_id, location, slot)
+    ) WITHOUT ROWID;
+    """
+)
+# The log of every command played in a game, and periodic snapshots to replay it from
+cur.execute(
+    """
+    CREATE TABLE IF NOT EXISTS game_events (
+        game_id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        command TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (game_id, seq)
+    ) WITHOUT ROWID;
+    """
+)
+cur.execute(
+    """
+    CREATE TABLE IF NOT EXISTS game_snapshots (
+        game_id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        game_data BLOB NOT NULL,
+        PRIMARY KEY (game_id, seq)
+    ) WITHOUT ROWID;
+    """
+)
+cur.execute(
+    """
+    CREATE TABLE IF NOT EXISTS rigged (
         count INTEGER NOT NULL
     );
     """
 )
+# Computer players left on the roster by games that ended before they were taken off it
+cur.execute(
+    """
+    DELETE FROM users WHERE user_id < 0 AND game_id IS NULL;
+    """
+)
 cur.execute(
     """
-    INSERT INTO rigged (count) VALUES (0);
+    INSERT INTO rigged (count) SELECT 0 WHERE NOT EXISTS (SELECT * FROM rigged);
     """
 )
 
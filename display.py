@@ -1,6 +1,10 @@
 from maps import MAPS
-from PIL import Image, ImageDraw
+from PIL import GifImagePlugin, Image, ImageDraw, ImageFont
 from io import BytesIO
+import os
+from collections import OrderedDict
+from functools import lru_cache
+import engine
 
 COLOUR_CODES = {
     "red"    : (200, 0, 0),
@@ -12,31 +16,342 @@ COLOUR_CODES = {
     "grey"   : (128, 128, 128)
 }
 
-def draw_map(game: dict) -> BytesIO:
-    """Function for returning a JPG representation of the current state of the game."""
-    game_map = MAPS[game["map"]]
+# How maps are sent: "jpeg", "png" (with a small palette) or "webp", plus quality settings. If MAX_BYTES is set,
+# quality is lowered as far as needed to fit it. These come from the environment so render workers share them.
+IMAGE_FORMAT = os.environ.get("RISK_MAP_FORMAT", "jpeg").lower()
+JPEG_QUALITY = int(os.environ.get("RISK_MAP_QUALITY", 75))
+WEBP_QUALITY = int(os.environ.get("RISK_MAP_QUALITY", 80))
+PALETTE_COLOURS = 64
+MAX_BYTES = int(os.environ["RISK_MAP_MAX_BYTES"]) if os.environ.get("RISK_MAP_MAX_BYTES") else None
+MAP_FILENAME = "map." + {"jpeg" : "jpg"}.get(IMAGE_FORMAT, IMAGE_FORMAT)
+
+# The same font ImageDraw falls back to, loaded once rather than on every render
+FONT = ImageFont.load_default()
+
+# Decoded map images, by map name; renders draw on copies of these
+_base_images = {}
+
+# Maps whose images render workers decode as they start: just the default one, which most games are played on.
+# The rest are loaded and decoded on their first render, so that adding maps doesn't slow every worker down.
+PRELOADED_MAPS = ("classic",)
+
+
+def get_base_image(map_name: str) -> Image.Image:
+    """Returns the decoded, unmarked image of a map, reading it from disk the first time it's needed."""
+    if map_name not in _base_images:
+        with Image.open(MAPS[map_name]["file"]) as img:
+            img.load()
+            _base_images[map_name] = img
+    return _base_images[map_name]
+
+
+def preload_maps() -> None:
+    """Decodes the images of PRELOADED_MAPS ahead of time, so that their first render isn't any slower."""
+    for map_name in PRELOADED_MAPS:
+        get_base_image(map_name)
+
+
+def board_state(game: dict) -> tuple:
+    """Boils a game down to what's drawn on its map: (map name, each bubble's colour name, each bubble's troops).
+    It's cheap to build, hashable, and identical for identical-looking boards."""
     territory_data = game["territories"]
-    bubbles = game_map["bubbles"]
-
-    # Readying appropriate map file
-    with Image.open(game_map["file"]) as img:
-        draw = ImageDraw.Draw(img)
-
-        # Draw in each territory's bubble (troop amount and ownership indicator)
-        for territory_name, bubble_pos in bubbles.items():
-            # Determining the properties of the bubble
-            owner  = territory_data[territory_name]["owner"]
-            troops = territory_data[territory_name]["troops"]
-            colour = COLOUR_CODES["grey" if owner == None else game["players"][str(owner)]["colour"]]
-            bubble_box = (bubble_pos[0]-7, bubble_pos[1]-7, bubble_pos[0]+7, bubble_pos[1]+7)
-            
-            # Drawing in the coloured circle
-            draw.ellipse(bubble_box, fill=colour)
-            # and the number of troops
-            draw.text((bubble_box[0] + 2 + (0 if troops > 9 else 3), bubble_box[1] + 2), str(troops), font=draw.getfont(), fill=((0, 0, 0) if colour == (255, 245, 0) else (255, 255, 255)))
-
-        # Saving scribbled-on image to a byte array, and returning it
-        byte_arr = BytesIO()
-        img.save(byte_arr, format="JPEG")
-        byte_arr.seek(0)
-        return byte_arr
\ No newline at end of file
+    colours, troops = [], []
+    for territory_name in MAPS[game["map"]]["bubbles"]:
+        owner = territory_data[territory_name]["owner"]
+        colours.append("grey" if owner == None else game["players"][str(owner)]["colour"])
+        troops.append(territory_data[territory_name]["troops"])
+    return (game["map"], tuple(colours), tuple(troops))
+
+
+# Longest a message can be, which a text map (along with whatever it's sent with) has to fit into
+MESSAGE_LIMIT = 2000
+
+
+def draw_text_map(game: dict) -> str:
+    """Returns the board as a compact table of each continent's territories, owners' colours and troops.
+    It needs no image work at all, for games that would rather not have a map attached to every turn."""
+    map_data = MAPS[game["map"]]
+    territories = game["territories"]
+    width = max(len(name) for name in territories)
+    lines = []
+    for continent in map_data["continents"]:
+        owners = {territories[name]["owner"] for name in continent["territories"]}
+        holder = next(iter(owners)) if len(owners) == 1 else None
+        heading = f"{continent['name']} (+{continent['bonus']})"
+        if holder is not None:
+            heading += f", held by {game['players'][str(holder)]['colour']}"
+        lines.append(heading)
+        for name in map_data["connections"]:
+            if name in continent["territories"]:
+                owner = territories[name]["owner"]
+                colour = "-" if owner is None else game["players"][str(owner)]["colour"]
+                lines.append(f"  {name:<{width}} {colour:<6} {territories[name]['troops']:>4}")
+    return "```\n" + "\n".join(lines) + "\n```"
+
+
+# Recently rendered maps, by board state, least recently used first
+RENDER_CACHE_SIZE = 64
+_renders = OrderedDict()
+_render_stats = {"hits" : 0, "misses" : 0}
+
+
+def render_cache_stats() -> dict:
+    """Returns how many renders were served from the cache ("hits") and how many had to be drawn ("misses")."""
+    return {**_render_stats, "size" : len(_renders)}
+
+
+def draw_map(game: dict) -> BytesIO:
+    """Function for returning an image (in IMAGE_FORMAT) of the current state of the game."""
+    return BytesIO(render_board(board_state(game), tuple(game["turn_order"])))
+
+
+def render_board(board: tuple, key = None) -> bytes:
+    """Returns the encoded image bytes of a board_state, drawing it only if the same board hasn't been drawn recently.
+    Boards rendered with the same key (such as a game's turn order) are drawn by touching up the last one."""
+    data = cached_render(board)
+    if data is None:
+        data = _render(board, key)
+        cache_render(board, data)
+    return data
+
+
+def cached_render(board: tuple) -> bytes:
+    """Returns the encoded image bytes of a recently rendered board_state, or None (counting a miss) if there aren't any."""
+    data = _renders.get(board)
+    if data is None:
+        _render_stats["misses"] += 1
+        return None
+    _render_stats["hits"] += 1
+    _renders.move_to_end(board)
+    return data
+
+
+def cache_render(board: tuple, data: bytes) -> None:
+    """Remembers the encoded image bytes of a rendered board_state."""
+    _renders[board] = data
+    if len(_renders) > RENDER_CACHE_SIZE:
+        _renders.popitem(last=False)
+
+
+def draw_bubble(draw: ImageDraw.ImageDraw, bubble_pos: tuple[int, int], colour_name: str, troops: int) -> None:
+    """Draws a territory's bubble (troop amount and ownership indicator) centred on bubble_pos."""
+    # Determining the properties of the bubble
+    colour = COLOUR_CODES[colour_name]
+    bubble_box = (bubble_pos[0]-7, bubble_pos[1]-7, bubble_pos[0]+7, bubble_pos[1]+7)
+
+    # Drawing in the coloured circle
+    draw.ellipse(bubble_box, fill=colour)
+    # and the number of troops
+    draw.text((bubble_box[0] + 2 + (0 if troops > 9 else 3), bubble_box[1] + 2), str(troops), font=FONT, fill=((0, 0, 0) if colour == (255, 245, 0) else (255, 255, 255)))
+
+
+# Pre-drawn bubbles by (colour name, troops), made the first time they're needed. Bubbles with more troops than
+# SPRITE_MAX_TROOPS are rare enough that they're drawn directly instead of being kept around.
+SPRITE_MAX_TROOPS = 199
+_sprites = {}
+
+# A sprite's bubble sits in its top left corner, with room to the right and below for long troop counts
+_SPRITE_SIZE = (28, 24)
+
+
+def get_bubble_sprite(colour_name: str, troops: int) -> Image.Image:
+    """Returns a transparent image of a bubble, to be pasted with its top left corner 7 pixels up and left of
+    the bubble's position."""
+    sprite = _sprites.get((colour_name, troops))
+    if sprite is None:
+        sprite = Image.new("RGBA", _SPRITE_SIZE, (0, 0, 0, 0))
+        draw_bubble(ImageDraw.Draw(sprite), (7, 7), colour_name, troops)
+        _sprites[(colour_name, troops)] = sprite
+    return sprite
+
+
+def _stamp_bubble(img: Image.Image, bubble_pos: tuple[int, int], colour_name: str, troops: int) -> None:
+    """Puts a bubble onto an image, pasting its sprite or drawing it if it's too big to have one."""
+    if troops <= SPRITE_MAX_TROOPS:
+        sprite = get_bubble_sprite(colour_name, troops)
+        img.paste(sprite, (bubble_pos[0]-7, bubble_pos[1]-7), sprite)
+    else:
+        draw_bubble(ImageDraw.Draw(img), bubble_pos, colour_name, troops)
+
+
+def _bubble_box(bubble_pos: tuple[int, int]) -> tuple[int, int, int, int]:
+    """Returns the area of the map that a bubble's sprite covers."""
+    return (bubble_pos[0]-7, bubble_pos[1]-7, bubble_pos[0]-7 + _SPRITE_SIZE[0], bubble_pos[1]-7 + _SPRITE_SIZE[1])
+
+
+@lru_cache(maxsize=None)
+def _bubble_groups(map_name: str) -> tuple[int]:
+    """Labels each of a map's bubbles with a group, such that bubbles whose areas overlap (directly or through
+    other bubbles) share a group. Repainting whole groups means no bubble is ever left half painted over."""
+    boxes = [_bubble_box(bubble_pos) for bubble_pos in MAPS[map_name]["bubbles"].values()]
+    groups = list(range(len(boxes)))
+    def find(i):
+        while groups[i] != i:
+            groups[i] = groups[groups[i]]
+            i = groups[i]
+        return i
+    for i, a in enumerate(boxes):
+        for j in range(i):
+            b = boxes[j]
+            if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                groups[find(i)] = find(j)
+    return tuple(find(i) for i in range(len(boxes)))
+
+
+# The last image drawn for each recently rendered key, along with the board it shows
+RASTER_CACHE_SIZE = 32
+_rasters = OrderedDict()
+
+
+def _render(board: tuple, key = None) -> bytes:
+    """Draws a board_state onto its map. With a key whose last image is still around, only the bubbles that
+    changed since then (and any they overlap) are repainted onto it."""
+    previous = _rasters.pop(key, None) if key is not None else None
+    img, _ = _paint(board, previous)
+
+    if key is not None:
+        _rasters[key] = (board, img)
+        if len(_rasters) > RASTER_CACHE_SIZE:
+            _rasters.popitem(last=False)
+
+    # Encoding the scribbled-on image
+    return encode_image(img, board[0])
+
+
+def _paint(board: tuple, previous: tuple = None) -> tuple[Image.Image, list]:
+    """Paints a board_state, touching up the image of a (board, image) pair if given one for the same map.
+    Returns the image, and the indices of the bubbles that were repainted onto the old one (None if fresh)."""
+    map_name, colours, troop_counts = board
+    bubbles = list(MAPS[map_name]["bubbles"].values())
+
+    if previous is not None and previous[0][0] == map_name:
+        # Patching the changed areas back to the plain map, then restamping their bubbles
+        (_, old_colours, old_troop_counts), img = previous
+        groups = _bubble_groups(map_name)
+        changed = {
+            groups[i] for i in range(len(bubbles))
+            if colours[i] != old_colours[i] or troop_counts[i] != old_troop_counts[i]
+        }
+        repaint = [i for i in range(len(bubbles)) if groups[i] in changed]
+        base = get_base_image(map_name)
+        for i in repaint:
+            box = _bubble_box(bubbles[i])
+            img.paste(base.crop(box), box[:2])
+        for i in repaint:
+            _stamp_bubble(img, bubbles[i], colours[i], troop_counts[i])
+        return img, repaint
+
+    # Stamping every bubble onto a fresh copy of the map
+    img = get_base_image(map_name).copy()
+    for bubble_pos, colour_name, troops in zip(bubbles, colours, troop_counts):
+        _stamp_bubble(img, bubble_pos, colour_name, troops)
+    return img, None
+
+
+def _save(img: Image.Image, **options) -> bytes:
+    """Saves an image to bytes."""
+    byte_arr = BytesIO()
+    img.save(byte_arr, **options)
+    return byte_arr.getvalue()
+
+
+@lru_cache(maxsize=None)
+def _palette(map_name: str, colours: int) -> Image.Image:
+    """Returns a palette image for a map: the colours that best fit its plain image, plus the exact bubble and
+    text colours, so the bubbles never pick up quantization artifacts."""
+    fixed = list(COLOUR_CODES.values()) + [(255, 255, 255)]
+    adaptive = get_base_image(map_name).convert("RGB").quantize(colours - len(fixed)).getpalette()[:3*(colours - len(fixed))]
+    palette = Image.new("P", (1, 1))
+    palette.putpalette(adaptive + [value for colour in fixed for value in colour])
+    return palette
+
+
+def encode_image(img: Image.Image, map_name: str, format: str = None, max_bytes: int = None) -> bytes:
+    """Encodes a rendered map in the given format (IMAGE_FORMAT by default). If the result is bigger than
+    max_bytes (MAX_BYTES by default), lower quality settings are tried until one fits, settling for the smallest."""
+    format = format or IMAGE_FORMAT
+    max_bytes = max_bytes or MAX_BYTES
+    if format == "png":
+        attempts = [
+            lambda colours=colours: _save(img.convert("RGB").quantize(palette=_palette(map_name, colours), dither=Image.Dither.NONE), format="PNG", optimize=True)
+            for colours in (PALETTE_COLOURS, 32, 16)
+        ]
+    elif format in ("jpeg", "webp"):
+        quality = JPEG_QUALITY if format == "jpeg" else WEBP_QUALITY
+        attempts = [
+            lambda quality=quality: _save(img.convert("RGB"), format=format.upper(), quality=quality)
+            for quality in [quality] + [q for q in (60, 45, 30, 20) if q < quality]
+        ]
+    else:
+        raise ValueError(f"Unknown image format '{format}'; expected jpeg, png or webp.")
+
+    data = attempts[0]()
+    for attempt in attempts[1:]:
+        if max_bytes is None or len(data) <= max_bytes:
+            break
+        data = min(data, attempt(), key=len)
+    return data
+
+
+# Replays are animated GIFs with one frame per turn. Games with more turns than REPLAY_MAX_FRAMES skip evenly
+# through them, which keeps the time and size of a replay bounded however long the game was.
+REPLAY_MAX_FRAMES = 240
+REPLAY_FRAME_MS = 400
+REPLAY_LAST_FRAME_MS = 4000
+
+
+def turn_boards(game: dict, events, max_frames: int = None) -> list[tuple]:
+    """Plays an iterable of a game's logged events onto its starting state, returning the board_state at the end
+    of each turn (and at the end of the log), with unchanged boards left out and no more than max_frames boards
+    in all. Only every stride-th board is kept, the stride doubling whenever twice max_frames have piled up, so
+    that however long the game, its boards never take more memory than that."""
+    max_frames = max_frames or REPLAY_MAX_FRAMES
+    boards = [board_state(game)]
+    last, count, stride = boards[0], 0, 1
+    for seq, command, payload in events:
+        active_player = game["active_player"]
+        engine.apply_event(game, command, payload)
+        if game["active_player"] == active_player:
+            continue
+        board = board_state(game)
+        if board == last:
+            continue
+        last, count = board, count + 1
+        if count % stride == 0:
+            boards.append(board)
+            if len(boards) > 2 * max_frames:
+                boards, stride = boards[::2], stride * 2
+    board = board_state(game)
+    if board != boards[-1]:
+        boards.append(board)
+    if len(boards) > max_frames:
+        step = (len(boards) - 1) / (max_frames - 1)
+        boards = [boards[round(i * step)] for i in range(max_frames)]
+    return boards
+
+
+def draw_replay(boards: list[tuple]) -> bytes:
+    """Returns an animated GIF of a series of board_states. Frames are written as they're painted, each holding
+    only the part of the map that changed, all in one palette shared with the whole animation."""
+    map_name = boards[0][0]
+    palette = _palette(map_name, 256)
+    img, _ = _paint(boards[0])
+    frame = img.quantize(palette=palette, dither=Image.Dither.NONE)
+    header, _ = GifImagePlugin.getheader(frame, info={"loop" : 0})
+    parts = header + GifImagePlugin.getdata(frame, duration=REPLAY_LAST_FRAME_MS if len(boards) == 1 else REPLAY_FRAME_MS, disposal=1)
+
+    for i in range(1, len(boards)):
+        img, repainted = _paint(boards[i], (boards[i-1], img))
+        if not repainted:
+            continue
+        bubbles = list(MAPS[map_name]["bubbles"].values())
+        boxes = [_bubble_box(bubbles[j]) for j in repainted]
+        box = (
+            max(0, min(box[0] for box in boxes)), max(0, min(box[1] for box in boxes)),
+            min(img.width, max(box[2] for box in boxes)), min(img.height, max(box[3] for box in boxes))
+        )
+        frame = img.crop(box).quantize(palette=palette, dither=Image.Dither.NONE)
+        duration = REPLAY_LAST_FRAME_MS if i == len(boards) - 1 else REPLAY_FRAME_MS
+        parts += GifImagePlugin.getdata(frame, offset=box[:2], duration=duration, disposal=1)
+
+    return b"".join(parts) + b";"
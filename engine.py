@@ -0,0 +1,439 @@
+from maps import MAPS, TOPOLOGY
+from functools import lru_cache
+import random as r
+
+# The game rules, kept free of Discord so that they can also be used to replay a game's event log.
+# The bot validates commands and words the announcements; the functions here only change the game.
+
+COLOURS = ("red", "blue", "yellow", "green", "brown", "black")
+
+
+def generate_new_game_data(
+    players: list[int],
+    map: str = "classic",
+    randomfill: bool = False
+) -> dict:
+    """Creates and returns a dictionary with game data."""
+    game = {}
+    map_data = MAPS[map]
+
+    # Initializing players
+    deployable_troops = 0 if randomfill else (40, 35, 30, 25, 20)[len(players)-2]
+    r.shuffle(players)
+    game["players"] = {
+        str(player_id) : { # JSON doesn't allow integer keys; pain ensues
+            "turn_number" : i+1,
+            "colour" : COLOURS[i],
+            "territories" : [],
+            "cards" : [],
+            "deployable_troops" : deployable_troops,
+            "holdings" : 0
+        } for i, player_id in enumerate(players)
+    }
+
+    # Initializing territories
+    game["map"] = map
+    game["territories"] = {
+        key : {"owner" : None, "troops" : 0}
+        for key in map_data["connections"].keys()
+    }
+    if randomfill:
+        for t_name, t_data in game["territories"].items():
+            lucky_player = r.choice(players)
+            t_data["owner"] = lucky_player
+            t_data["troops"] = r.randint(1, 10)
+            _take(game, game["players"][str(lucky_player)], t_name)
+        player = game["players"][str(players[0])]
+        player["deployable_troops"] = calculate_new_troops(game, str(players[0]))
+
+    # Initializing deck and discard pile
+    territory_names = [_ for _ in map_data["connections"].keys()]
+    r.shuffle(territory_names)
+    game["deck"] = [("Wild", None), ("Wild", None)] + [
+        (("Infantry", "Cavalry", "Artillery")[i%3], territory_names[i])
+        for i in range(len(territory_names))
+    ]
+    r.shuffle(game["deck"])
+    game["discard_pile"] = []
+
+    # Other game variables
+    game["turn_order"] = players.copy()
+    game["active_player"] = 1
+    game["eliminated_players"] = []
+    game["turn_stage"] = 1
+    game["in_pregame"] = False if randomfill else True
+    game["unclaimed_territories"] = 0 if randomfill else len(territory_names)
+    game["last_attack"] = None
+    game["card_claimed"] = False
+    game["trade_count"] = 0
+    game["active"] = True
+
+    return game
+
+
+def holdings(game: dict, player_id: str) -> int:
+    """Returns the territories a player owns as a bitmask (see maps.compile_map). Players keep theirs up to date
+    in "holdings", but games stored without one get it worked out from their territory lists here."""
+    player = game["players"][str(player_id)]
+    if "holdings" not in player:
+        index = TOPOLOGY[game["map"]]["index"]
+        player["holdings"] = sum(1 << index[name] for name in player["territories"])
+    return player["holdings"]
+
+
+def _take(game: dict, player: dict, territory_name: str) -> None:
+    """Adds a territory to a player's territories."""
+    player["territories"].append(territory_name)
+    if "holdings" in player:
+        player["holdings"] |= 1 << TOPOLOGY[game["map"]]["index"][territory_name]
+
+
+def _lose(game: dict, player: dict, territory_name: str) -> None:
+    """Removes a territory from a player's territories."""
+    player["territories"].remove(territory_name)
+    if "holdings" in player:
+        player["holdings"] &= ~(1 << TOPOLOGY[game["map"]]["index"][territory_name])
+
+
+def calculate_new_troops(game: dict, player_id: int) -> int:
+    """Calculates the number of new troops a player would receive."""
+    player_territories = game["players"][str(player_id)]["territories"]
+
+    #The number of territories you occupy.
+    new_troops = len(player_territories) // 3
+    if new_troops < 3: new_troops = 3
+
+    #The value of the continents you control.
+    held = holdings(game, player_id)
+    for continent, bonus in TOPOLOGY[game["map"]]["continents"]:
+        if held & continent == continent:
+            new_troops += bonus
+
+    return new_troops
+
+
+def begin_next_player_turn(game: dict) -> str:
+    """Ends current turn, starts next turn. Returns the id of the player whose turn it is."""
+    # Start by cycling active_player status to the next player
+    while True:
+        game["active_player"] += 1
+        if game["active_player"] > len(game["players"]):
+            game["active_player"] = 1
+        if game["active_player"] in game["eliminated_players"]:
+            continue
+        break
+
+    player_id = game["turn_order"][game["active_player"]-1]
+    player = game["players"][str(player_id)]
+
+    # Handle pregame scenarios
+    if game["in_pregame"]:
+        if player["deployable_troops"] == 0:
+            game["in_pregame"] = False
+        else:
+            return player_id
+
+    player["deployable_troops"] = calculate_new_troops(game, player_id)
+    game["turn_stage"] = 1 if len(player["cards"]) < 5 else 0
+    game["last_attack"] = None
+    game["card_claimed"] = False
+
+    return player_id
+
+
+def deploy(game: dict, player_id: str, territory_name: str, troops: int) -> bool:
+    """Deploys troops onto a territory, claiming it if it's unclaimed. Returns whether that ended the player's turn,
+    which every deployment in the pregame does."""
+    player = game["players"][str(player_id)]
+    territory = game["territories"][territory_name]
+    player["deployable_troops"] -= troops
+    territory["troops"] += troops
+    if territory["owner"] == None:
+        territory["owner"] = str(player_id)
+        game["unclaimed_territories"] -= 1
+        _take(game, player, territory_name)
+
+    # End turn if deploying in pregame
+    if game["in_pregame"]:
+        begin_next_player_turn(game)
+        return True
+    # If not in pregame and all troops deployed, enable attacking
+    if player["deployable_troops"] == 0:
+        game["turn_stage"] = 2
+    return False
+
+
+def roll_dice(army_size: int, defending_troops: int) -> tuple[list[int], list[int]]:
+    """Rolls the attacker's and defender's dice, each sorted from highest to lowest."""
+    off_dice = [r.randint(1, 6) for _ in range(army_size)]
+    def_dice = [r.randint(1, 6) for _ in range(2 if defending_troops > 1 else 1)]
+    off_dice.sort(reverse=True)
+    def_dice.sort(reverse=True)
+    return off_dice, def_dice
+
+
+def attack(
+    game: dict,
+    player_id: str,
+    target: str,
+    attacker: str,
+    army_size: int,
+    off_dice: list[int],
+    def_dice: list[int],
+    deck: list = None
+) -> dict:
+    """Resolves an attack with the given dice. Returns what happened as a dict with the casualties ("off_dead",
+    "def_dead") and whether the target was "conquered", who was "eliminated" (or None), whether that was a
+    "victory", whether a "card" was drawn, and the "deck" if it had to be reshuffled (passing that back in
+    as deck reproduces the same shuffle when replaying)."""
+    player = game["players"][str(player_id)]
+    off_territory = game["territories"][attacker]
+    def_territory = game["territories"][target]
+    result = {"off_dead" : 0, "def_dead" : 0, "conquered" : False, "eliminated" : None, "victory" : False, "card" : False, "deck" : None}
+
+    # Counting the casualties
+    for off_die, def_die in zip(off_dice, def_dice):
+        if off_die > def_die: result["def_dead"] += 1
+        else: result["off_dead"] += 1
+    off_territory["troops"] -= result["off_dead"]
+    def_territory["troops"] -= result["def_dead"]
+    game["last_attack"] = (target, attacker, army_size)
+
+    # If territory was conquered...
+    if def_territory["troops"] == 0:
+        result["conquered"] = True
+
+        # Transfer ownership and troops
+        conquered_player_id = def_territory["owner"]
+        conquered_player = game["players"][str(conquered_player_id)]
+        _lose(game, conquered_player, target)
+        _take(game, player, target)
+        def_territory["owner"] = str(player_id)
+        def_territory["troops"] = army_size
+        off_territory["troops"] -= army_size
+
+        # Eliminate a player if he's out of turf
+        if len(conquered_player["territories"]) == 0:
+            game["discard_pile"] += conquered_player["cards"]
+            conquered_player["cards"] = None
+            game["eliminated_players"].append(conquered_player["turn_number"])
+            result["eliminated"] = conquered_player_id
+
+        # Check for victory and the game's end
+        if len(player["territories"]) == len(MAPS[game["map"]]["connections"]):
+            result["victory"] = True
+            return result
+
+        # No more troops can follow the attack forward
+        if off_territory["troops"] - 1 < 1:
+            game["last_attack"] = None
+
+        # Giving a card if no card has been claimed this turn
+        if not game["card_claimed"]:
+            # Shuffling if necessary
+            if len(game["deck"]) == 0:
+                if deck is None:
+                    deck = [card for card in game["discard_pile"]]
+                    r.shuffle(deck)
+                game["deck"] = [card for card in deck]
+                game["discard_pile"] = []
+                result["deck"] = deck
+            player["cards"].append(game["deck"].pop())
+            game["card_claimed"] = True
+            result["card"] = True
+
+    # If user's army was crippled...
+    elif off_territory["troops"] == 1:
+        game["last_attack"] = None
+
+    return result
+
+
+# Blitzes roll dice for this many rounds at a time, rather than one die at a time
+BLITZ_BATCH = 64
+
+
+def blitz(
+    game: dict,
+    player_id: str,
+    target: str,
+    attacker: str,
+    army_size: int,
+    rolls: str = None,
+    deck: list = None
+) -> dict:
+    """Attacks over and over until the target is conquered or the attacker is down to one troop, with up to
+    army_size dice a round. Returns the last attack's result (see attack) with the casualties totalled over
+    every round, the "army_size" of the last round, the number of "rounds", and the "rolls" made, written
+    compactly (e.g. "653/64,52/3"). Passing those back in as rolls reproduces the blitz when replaying."""
+    off_territory = game["territories"][attacker]
+    def_territory = game["territories"][target]
+    if rolls is not None:
+        rounds = [
+            [[int(die) for die in dice] for dice in entry.split("/")]
+            for entry in rolls.split(",")
+        ]
+    else:
+        rounds, dice = [], []
+
+    off_dead = def_dead = 0
+    i = 0
+    while True:
+        size = min(army_size, off_territory["troops"] - 1)
+        if rolls is not None:
+            off_dice, def_dice = rounds[i]
+        else:
+            # Drawing a batch of dice whenever the last one runs out; five dice cover any round
+            if len(dice) < 5:
+                dice += r.choices(range(1, 7), k=5 * BLITZ_BATCH)
+            off_dice = sorted(dice[-size:], reverse=True)
+            del dice[-size:]
+            defending = 2 if def_territory["troops"] > 1 else 1
+            def_dice = sorted(dice[-defending:], reverse=True)
+            del dice[-defending:]
+            rounds.append((off_dice, def_dice))
+        i += 1
+        result = attack(game, player_id, target, attacker, size, off_dice, def_dice, deck)
+        off_dead += result["off_dead"]
+        def_dead += result["def_dead"]
+        if result["conquered"] or off_territory["troops"] == 1:
+            break
+
+    result.update(off_dead=off_dead, def_dead=def_dead, army_size=size, rounds=i)
+    result["rolls"] = rolls if rolls is not None else ",".join(
+        "".join(map(str, off_dice)) + "/" + "".join(map(str, def_dice)) for off_dice, def_dice in rounds
+    )
+    return result
+
+
+def advance(game: dict, troops: int) -> None:
+    """Moves troops from the last attack's attacking territory into the territory it just conquered."""
+    target, attacker, _ = game["last_attack"]
+    game["territories"][attacker]["troops"] -= troops
+    game["territories"][target]["troops"] += troops
+    game["last_attack"] = None
+
+
+def has_path(game: dict, player_id: str, start: str, destination: str) -> bool:
+    """Returns whether a player owns a chain of adjacent territories leading from start to destination."""
+    topology = TOPOLOGY[game["map"]]
+    index = topology["index"]
+    return bool(topology["adjacency"][index[start]] & components(game["map"], holdings(game, player_id))[index[destination]])
+
+
+@lru_cache(maxsize=1024)
+def components(map_name: str, mask: int) -> tuple[int]:
+    """Splits a set of territories (a bitmask) into groups connected through each other. Returns, for each territory,
+    the bitmask of its group, or 0 if it isn't in the set. Cached by set, so a player's groups are only worked out
+    again once what they own has changed."""
+    adjacency = TOPOLOGY[map_name]["adjacency"]
+    labels = [0] * len(adjacency)
+    unlabelled = mask
+    while unlabelled:
+        # Flooding outwards from the lowest territory yet to be labelled
+        group = frontier = unlabelled & -unlabelled
+        while frontier:
+            reached = 0
+            while frontier:
+                bit = frontier & -frontier
+                reached |= adjacency[bit.bit_length() - 1]
+                frontier ^= bit
+            frontier = reached & mask & ~group
+            group |= frontier
+        unlabelled &= ~group
+        remaining = group
+        while remaining:
+            bit = remaining & -remaining
+            labels[bit.bit_length() - 1] = group
+            remaining ^= bit
+    return tuple(labels)
+
+
+def fortify(game: dict, start: str, destination: str, troops: int) -> str:
+    """Makes the end-of-turn troop movement and starts the next turn. Returns the id of the player whose turn it is."""
+    game["territories"][start]["troops"] -= troops
+    game["territories"][destination]["troops"] += troops
+    return begin_next_player_turn(game)
+
+
+def trade(game: dict, player_id: str, cards: list) -> tuple[int, str]:
+    """Trades in a set of cards. Returns the number of new troops and the territory that received the two bonus
+    troops for matching one of the cards, or None if there was no such territory."""
+    player = game["players"][str(player_id)]
+
+    # Discarding cards and figuring out if there's a bonus territory
+    bonus_territory = None
+    for card in cards:
+        if not bonus_territory and card[1] in player["territories"]:
+            bonus_territory = card[1]
+        player["cards"].remove(card)
+        game["discard_pile"].append(card)
+
+    # Success! Have some troops
+    try: new_troops = (4, 6, 8, 10, 12, 15)[game["trade_count"]]
+    except IndexError: new_troops = ((game["trade_count"]-2)*5) #20, 25, 30...
+    player["deployable_troops"] += new_troops
+    if bonus_territory:
+        game["territories"][bonus_territory]["troops"] += 2
+    game["trade_count"] += 1
+
+    # Allowing deployment if player was previously locked into a trade
+    if game["turn_stage"] == 0:
+        game["turn_stage"] = 1
+
+    return new_troops, bonus_territory
+
+
+def resign(game: dict, player_id: str) -> str:
+    """Removes a player from the game. Returns the id of the winner if that leaves only one player, otherwise None."""
+    player = game["players"][str(player_id)]
+    game["discard_pile"] += player["cards"]
+    player["cards"] = None
+    game["eliminated_players"].append(player["turn_number"])
+
+    # Determine if game is over
+    if len(game["players"]) == len(game["eliminated_players"]) + 1:
+        return begin_next_player_turn(game)
+
+    # If it was still the deployment stage of the game, give each player 5 troops
+    if game["in_pregame"]:
+        for nonquitter in game["players"].keys():
+            if nonquitter not in game["eliminated_players"]:
+                game["players"][str(nonquitter)]["deployable_troops"] += 5
+    # If it was the resigning player's turn, cycle active_player
+    if game["active_player"] == player["turn_number"]:
+        begin_next_player_turn(game)
+    return None
+
+
+def apply_event(game: dict, command: str, payload: dict) -> None:
+    """Replays a logged command onto a game. Payloads hold the command's arguments, along with whatever
+    randomness it involved, so replaying gives the same result as the original command."""
+    if command == "deploy":
+        deploy(game, payload["player"], payload["territory"], payload["troops"])
+    elif command == "attack":
+        attack(
+            game, payload["player"], payload["target"], payload["attacker"], payload["army_size"],
+            payload["off_dice"], payload["def_dice"], payload.get("deck")
+        )
+    elif command == "blitz":
+        blitz(
+            game, payload["player"], payload["target"], payload["attacker"], payload["army_size"],
+            payload["rolls"], payload.get("deck")
+        )
+    elif command == "advance":
+        advance(game, payload["troops"])
+    elif command == "move":
+        fortify(game, payload["start"], payload["destination"], payload["troops"])
+    elif command == "trade":
+        # Cards may be held as lists or tuples depending on how the game was stored, so use the held ones
+        hand = game["players"][str(payload["player"])]["cards"]
+        trade(game, payload["player"], [next(held for held in hand if list(held) == list(card)) for card in payload["cards"]])
+    elif command == "endturn":
+        begin_next_player_turn(game)
+    elif command == "resign":
+        resign(game, payload["player"])
+    elif command == "map_mode":
+        game["map_mode"] = payload["mode"]
+    elif command != "start":
+        raise ValueError(f"Unknown game event '{command}'.")
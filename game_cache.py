@@ -0,0 +1,76 @@
+from collections import OrderedDict
+import time
+
+# How many games are kept in memory at once, and how long an untouched game may linger before being evicted
+MAX_GAMES = 256
+IDLE_SECONDS = 600
+
+_games = OrderedDict() # game_id -> game data, least recently used first
+_last_used = {}
+_dirty = set()
+
+
+def get(game_id: int) -> dict:
+    """Returns a cached game and marks it as recently used, or returns None if it isn't cached."""
+    game = _games.get(game_id)
+    if game is not None:
+        _games.move_to_end(game_id)
+        _last_used[game_id] = time.monotonic()
+    return game
+
+
+def put(game_id: int, game: dict, dirty: bool = False) -> list[tuple[int, dict]]:
+    """Caches a game, optionally flagging it as needing a write. Returns any dirty games evicted to make room."""
+    _games[game_id] = game
+    _games.move_to_end(game_id)
+    _last_used[game_id] = time.monotonic()
+    if dirty:
+        _dirty.add(game_id)
+    evicted = []
+    while len(_games) > MAX_GAMES:
+        old_id, old_game = _games.popitem(last=False)
+        if _forget(old_id):
+            evicted.append((old_id, old_game))
+    return evicted
+
+
+def mark_clean(game_id: int, game: dict) -> None:
+    """Clears a game's dirty flag, unless it has been replaced since the written copy was taken."""
+    if _games.get(game_id) is game:
+        _dirty.discard(game_id)
+
+
+def is_dirty(game_id: int) -> bool:
+    """Returns whether a cached game has changes that haven't been written yet."""
+    return game_id in _dirty
+
+
+def discard(game_id: int) -> None:
+    """Drops a game from the cache without writing it."""
+    _games.pop(game_id, None)
+    _forget(game_id)
+
+
+def dirty_games() -> list[tuple[int, dict]]:
+    """Returns every cached game with unwritten changes."""
+    return [(game_id, _games[game_id]) for game_id in _dirty]
+
+
+def evict_idle() -> list[tuple[int, dict]]:
+    """Evicts games that haven't been used in a while. Returns the evicted games that still need writing."""
+    cutoff = time.monotonic() - IDLE_SECONDS
+    evicted = []
+    for game_id in [game_id for game_id, last_used in _last_used.items() if last_used < cutoff]:
+        game = _games.pop(game_id)
+        if _forget(game_id):
+            evicted.append((game_id, game))
+    return evicted
+
+
+def _forget(game_id: int) -> bool:
+    """Clears a game's bookkeeping; returns whether it was dirty."""
+    _last_used.pop(game_id, None)
+    if game_id in _dirty:
+        _dirty.discard(game_id)
+        return True
+    return False
@@ -0,0 +1,219 @@
+from cards import CARD_TYPES, decode as decode_card, encode as encode_card
+from maps import MAPS, TOPOLOGY
+from array import array
+import json
+import struct
+
+# Every encoding starts with these, so that it can't be mistaken for JSON and so that old encodings stay readable.
+# Version 2 added the map's fingerprint (see maps.compile_map) after its name.
+MAGIC = b"RK"
+VERSION = 2
+
+COLOURS = ("red", "blue", "yellow", "green", "brown", "black")
+
+# Keys of a running game that the binary layout covers; anything else is carried along as JSON
+_KEYS = (
+    "players", "map", "territories", "deck", "discard_pile", "turn_order", "active_player", "eliminated_players",
+    "turn_stage", "in_pregame", "unclaimed_territories", "last_attack", "card_claimed", "trade_count", "active"
+)
+
+_HEADER = struct.Struct("<2sBB") # magic, version, length of the map name
+_FINGERPRINT = struct.Struct("<I")
+_TURN = struct.Struct("<BBBBHHB") # seats, active player, turn stage, flags, unclaimed territories, trade count, eliminated players
+_LAST_ATTACK = struct.Struct("<HHB") # target, attacker, army size
+_PLAYER = struct.Struct("<qBIH") # player id, colour, deployable troops, card count
+_COUNT = struct.Struct("<I")
+_NO_CARDS = 0xFFFF # Card count of an eliminated player, whose cards are None rather than empty
+
+# Bits of the flags byte
+_IN_PREGAME, _CARD_CLAIMED, _ACTIVE, _HAS_LAST_ATTACK = 1, 2, 4, 8
+
+
+def _territory_index(map_name: str) -> dict:
+    """Returns a {territory name : index} dict following the order of the map's connections."""
+    return TOPOLOGY[map_name]["index"]
+
+
+def can_encode(game: dict) -> bool:
+    """Returns whether a game has the shape of a running game, which is all the binary layout handles."""
+    return (
+        bool(game.get("active")) and game.get("map") in MAPS and all(key in game for key in _KEYS)
+        and all(game["players"][str(player_id)]["turn_number"] == i+1 for i, player_id in enumerate(game["turn_order"]))
+    )
+
+
+def encode(game: dict) -> bytes:
+    """Encodes a running game into the compact binary layout."""
+    map_name = game["map"].encode()
+    index = _territory_index(game["map"])
+    seats = {player_id : seat for seat, player_id in enumerate(game["turn_order"])}
+
+    flags = (
+        (_IN_PREGAME if game["in_pregame"] else 0) | (_CARD_CLAIMED if game["card_claimed"] else 0)
+        | (_ACTIVE if game["active"] else 0) | (_HAS_LAST_ATTACK if game["last_attack"] else 0)
+    )
+    parts = [
+        _HEADER.pack(MAGIC, VERSION, len(map_name)), map_name, _FINGERPRINT.pack(TOPOLOGY[game["map"]]["fingerprint"]),
+        _TURN.pack(
+            len(seats), game["active_player"], game["turn_stage"], flags,
+            game["unclaimed_territories"], game["trade_count"], len(game["eliminated_players"])
+        ),
+        bytes(game["eliminated_players"])
+    ]
+    if game["last_attack"]:
+        target, attacker, army_size = game["last_attack"]
+        parts.append(_LAST_ATTACK.pack(index[target], index[attacker], army_size))
+
+    # Players, in turn order
+    for player_id in game["turn_order"]:
+        player = game["players"][str(player_id)]
+        cards = player["cards"]
+        parts.append(_PLAYER.pack(
+            int(player_id), COLOURS.index(player["colour"]), player["deployable_troops"],
+            _NO_CARDS if cards is None else len(cards)
+        ))
+        parts.append(array("H", [encode_card(card, index) for card in cards or []]).tobytes())
+
+    # Territories, in map order: owners as seat numbers plus one (zero being unowned), then troop counts
+    owners, troops = bytearray(len(index)), array("I", bytes(4 * len(index)))
+    for name, territory in game["territories"].items():
+        i = index[name]
+        owners[i] = 0 if territory["owner"] is None else seats[str(territory["owner"])] + 1
+        troops[i] = territory["troops"]
+    parts += [bytes(owners), troops.tobytes()]
+
+    # Deck and discard pile
+    for pile in (game["deck"], game["discard_pile"]):
+        parts.append(_COUNT.pack(len(pile)))
+        parts.append(array("H", [encode_card(card, index) for card in pile]).tobytes())
+
+    # Whatever else the game is carrying
+    extras = {key : value for key, value in game.items() if key not in _KEYS}
+    extras = json.dumps(extras).encode() if extras else b""
+    parts += [_COUNT.pack(len(extras)), extras]
+
+    return b"".join(parts)
+
+
+def decode(data: bytes) -> dict:
+    """Decodes a game encoded with encode. Territories are stored by their place on the map, so a game whose map
+    has had its territories renamed or reordered since can't be decoded, and raises a ValueError."""
+    magic, version, name_length = _HEADER.unpack_from(data)
+    if magic != MAGIC or version not in (1, VERSION):
+        raise ValueError(f"Not a version {VERSION} game encoding.")
+    offset = _HEADER.size
+    map_name = data[offset:offset+name_length].decode()
+    offset += name_length
+    # Version 1 encodings were all made before maps could be edited
+    if version > 1:
+        (fingerprint,) = _FINGERPRINT.unpack_from(data, offset)
+        offset += _FINGERPRINT.size
+        if fingerprint != TOPOLOGY[map_name]["fingerprint"]:
+            raise ValueError(f"The '{map_name}' map's territories have changed since this game was encoded.")
+    names = list(MAPS[map_name]["connections"])
+
+    seat_count, active_player, turn_stage, flags, unclaimed, trade_count, eliminated_count = _TURN.unpack_from(data, offset)
+    offset += _TURN.size
+    eliminated_players = list(data[offset:offset+eliminated_count])
+    offset += eliminated_count
+    last_attack = None
+    if flags & _HAS_LAST_ATTACK:
+        target, attacker, army_size = _LAST_ATTACK.unpack_from(data, offset)
+        last_attack = [names[target], names[attacker], army_size]
+        offset += _LAST_ATTACK.size
+
+    players, turn_order = {}, []
+    for seat in range(seat_count):
+        player_id, colour, deployable_troops, card_count = _PLAYER.unpack_from(data, offset)
+        offset += _PLAYER.size
+        cards = None
+        if card_count != _NO_CARDS:
+            codes = array("H", data[offset:offset + 2*card_count])
+            cards = [decode_card(code, names) for code in codes]
+            offset += 2*card_count
+        turn_order.append(str(player_id))
+        players[str(player_id)] = {
+            "turn_number" : seat+1,
+            "colour" : COLOURS[colour],
+            "territories" : [],
+            "cards" : cards,
+            "deployable_troops" : deployable_troops
+        }
+
+    owners = data[offset:offset+len(names)]
+    offset += len(names)
+    troops = array("I", data[offset:offset + 4*len(names)])
+    offset += 4*len(names)
+    territories = {}
+    for name, owner, troop_count in zip(names, owners, troops):
+        owner = None if owner == 0 else turn_order[owner-1]
+        territories[name] = {"owner" : owner, "troops" : troop_count}
+        if owner is not None:
+            players[owner]["territories"].append(name)
+
+    piles = []
+    for _ in range(2):
+        (count,) = _COUNT.unpack_from(data, offset)
+        offset += _COUNT.size
+        piles.append([decode_card(code, names) for code in array("H", data[offset:offset + 2*count])])
+        offset += 2*count
+
+    (extras_length,) = _COUNT.unpack_from(data, offset)
+    offset += _COUNT.size
+    extras = json.loads(data[offset:offset+extras_length]) if extras_length else {}
+
+    return {
+        "players" : players,
+        "map" : map_name,
+        "territories" : territories,
+        "deck" : piles[0],
+        "discard_pile" : piles[1],
+        "turn_order" : turn_order,
+        "active_player" : active_player,
+        "eliminated_players" : eliminated_players,
+        "turn_stage" : turn_stage,
+        "in_pregame" : bool(flags & _IN_PREGAME),
+        "unclaimed_territories" : unclaimed,
+        "last_attack" : last_attack,
+        "card_claimed" : bool(flags & _CARD_CLAIMED),
+        "trade_count" : trade_count,
+        "active" : bool(flags & _ACTIVE),
+        **extras
+    }
+
+
+def _sample_game(player_count: int = 6, map_name: str = "classic") -> dict:
+    """Builds a mid-game board with every territory claimed and cards spread around, for benchmarking."""
+    import random as r
+    names = list(MAPS[map_name]["connections"])
+    player_ids = [str(r.randrange(10**17, 10**18)) for _ in range(player_count)]
+    deck = [("Wild", None), ("Wild", None)] + [(CARD_TYPES[i%3], name) for i, name in enumerate(names)]
+    r.shuffle(deck)
+    players = {
+        player_id : {"turn_number" : i+1, "colour" : COLOURS[i], "territories" : [], "cards" : [deck.pop() for _ in range(3)], "deployable_troops" : 0}
+        for i, player_id in enumerate(player_ids)
+    }
+    territories = {}
+    for name in names:
+        owner = r.choice(player_ids)
+        territories[name] = {"owner" : owner, "troops" : r.randint(1, 30)}
+        players[owner]["territories"].append(name)
+    return {
+        "players" : players, "map" : map_name, "territories" : territories, "deck" : deck, "discard_pile" : [deck.pop() for _ in range(5)],
+        "turn_order" : player_ids, "active_player" : 2, "eliminated_players" : [], "turn_stage" : 2, "in_pregame" : False,
+        "unclaimed_territories" : 0, "last_attack" : [names[0], names[1], 3], "card_claimed" : True, "trade_count" : 4, "active" : True
+    }
+
+
+if __name__ == "__main__":
+    # Benchmark: encode/decode time and size against the JSON the games used to be stored as
+    from timeit import timeit
+    game = _sample_game()
+    runs = 2000
+    text, blob = json.dumps(game), encode(game)
+    print(f"{'':8}{'bytes':>8}{'encode (us)':>14}{'decode (us)':>14}")
+    for label, size, encoder, decoder in (
+        ("json", len(text.encode()), lambda: json.dumps(game), lambda: json.loads(text)),
+        ("binary", len(blob), lambda: encode(game), lambda: decode(blob))
+    ):
+        print(f"{label:8}{size:>8}{timeit(encoder, number=runs) / runs * 1e6:>14.1f}{timeit(decoder, number=runs) / runs * 1e6:>14.1f}")
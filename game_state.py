@@ -0,0 +1,312 @@
+from array import array
+from cards import decode as decode_card, encode as encode_card
+from engine import components, generate_new_game_data
+from maps import TOPOLOGY
+import random as r
+
+# The rules of engine.py over a compact game state, for when games are played many times over without the bot,
+# such as in simulations and in AI players' rollouts. Players are seats (their turn number minus one),
+# territories are ids (see maps.compile_map), cards are ints (see cards.encode), and nothing is formatted
+# for people to read. Game dicts convert to and from GameStates, and play out the same either way.
+
+# Troops for the first trades; later trades are worth 5 more each time
+TRADE_VALUES = (4, 6, 8, 10, 12, 15)
+
+
+class GameState:
+    """A running game. Its methods change it the way the engine functions of the same names change game dicts,
+    returning what happened as dicts of seats, territory ids and counts."""
+    __slots__ = (
+        "map", "player_ids", "colours", "owners", "troops", "holdings", "deployable_troops", "cards", "deck",
+        "discard_pile", "active_player", "eliminated_players", "turn_stage", "in_pregame", "unclaimed_territories",
+        "last_attack", "card_claimed", "trade_count", "active", "extras"
+    )
+
+    @classmethod
+    def new(cls, player_ids: list, map_name: str = "classic", randomfill: bool = False) -> "GameState":
+        """Starts a new game, the same way engine.generate_new_game_data does."""
+        return cls.from_game(generate_new_game_data([str(player_id) for player_id in player_ids], map_name, randomfill))
+
+    @classmethod
+    def from_game(cls, game: dict) -> "GameState":
+        """Builds the state of a running game dict."""
+        state = cls.__new__(cls)
+        topology = TOPOLOGY[game["map"]]
+        index = topology["index"]
+        seats = {str(player_id) : seat for seat, player_id in enumerate(game["turn_order"])}
+        players = [game["players"][str(player_id)] for player_id in game["turn_order"]]
+
+        state.map = game["map"]
+        state.player_ids = [str(player_id) for player_id in game["turn_order"]]
+        state.colours = [player["colour"] for player in players]
+        state.owners = array("b", [-1]) * len(topology["names"])
+        state.troops = array("l", bytes(array("l").itemsize * len(topology["names"])))
+        state.holdings = [0] * len(players)
+        for name, territory in game["territories"].items():
+            i = index[name]
+            state.troops[i] = territory["troops"]
+            if territory["owner"] is not None:
+                seat = seats[str(territory["owner"])]
+                state.owners[i] = seat
+                state.holdings[seat] |= 1 << i
+        state.deployable_troops = [player["deployable_troops"] for player in players]
+        state.cards = [None if player["cards"] is None else [encode_card(card, index) for card in player["cards"]] for player in players]
+        state.deck = [encode_card(card, index) for card in game["deck"]]
+        state.discard_pile = [encode_card(card, index) for card in game["discard_pile"]]
+        state.active_player = game["active_player"] - 1
+        state.eliminated_players = [turn_number - 1 for turn_number in game["eliminated_players"]]
+        state.turn_stage = game["turn_stage"]
+        state.in_pregame = game["in_pregame"]
+        state.unclaimed_territories = game["unclaimed_territories"]
+        state.last_attack = None
+        if game["last_attack"]:
+            target, attacker, army_size = game["last_attack"]
+            state.last_attack = (index[target], index[attacker], army_size)
+        state.card_claimed = game["card_claimed"]
+        state.trade_count = game["trade_count"]
+        state.active = game["active"]
+        state.extras = {key : value for key, value in game.items() if key not in _GAME_KEYS}
+        return state
+
+    def to_game(self) -> dict:
+        """Returns the state as a game dict. Territory lists come out in map order."""
+        names = TOPOLOGY[self.map]["names"]
+        players = {}
+        for seat, player_id in enumerate(self.player_ids):
+            players[player_id] = {
+                "turn_number" : seat+1,
+                "colour" : self.colours[seat],
+                "territories" : [names[i] for i in range(len(names)) if self.holdings[seat] >> i & 1],
+                "cards" : None if self.cards[seat] is None else [decode_card(code, names) for code in self.cards[seat]],
+                "deployable_troops" : self.deployable_troops[seat],
+                "holdings" : self.holdings[seat]
+            }
+        return {
+            "players" : players,
+            "map" : self.map,
+            "territories" : {
+                name : {"owner" : None if self.owners[i] < 0 else self.player_ids[self.owners[i]], "troops" : self.troops[i]}
+                for i, name in enumerate(names)
+            },
+            "deck" : [decode_card(code, names) for code in self.deck],
+            "discard_pile" : [decode_card(code, names) for code in self.discard_pile],
+            "turn_order" : list(self.player_ids),
+            "active_player" : self.active_player + 1,
+            "eliminated_players" : [seat + 1 for seat in self.eliminated_players],
+            "turn_stage" : self.turn_stage,
+            "in_pregame" : self.in_pregame,
+            "unclaimed_territories" : self.unclaimed_territories,
+            "last_attack" : None if self.last_attack is None else (names[self.last_attack[0]], names[self.last_attack[1]], self.last_attack[2]),
+            "card_claimed" : self.card_claimed,
+            "trade_count" : self.trade_count,
+            "active" : self.active,
+            **self.extras
+        }
+
+    def copy(self) -> "GameState":
+        """Returns a copy that can be played on without affecting this one."""
+        state = GameState.__new__(GameState)
+        for slot in GameState.__slots__:
+            setattr(state, slot, getattr(self, slot))
+        state.owners, state.troops = array("b", self.owners), array("l", self.troops)
+        state.holdings, state.deployable_troops = list(self.holdings), list(self.deployable_troops)
+        state.cards = [None if hand is None else list(hand) for hand in self.cards]
+        state.deck, state.discard_pile = list(self.deck), list(self.discard_pile)
+        state.eliminated_players = list(self.eliminated_players)
+        state.extras = dict(self.extras)
+        return state
+
+    def calculate_new_troops(self, seat: int) -> int:
+        """Returns the number of new troops a player would receive."""
+        held = self.holdings[seat]
+        new_troops = max(3, held.bit_count() // 3)
+        for continent, bonus in TOPOLOGY[self.map]["continents"]:
+            if held & continent == continent:
+                new_troops += bonus
+        return new_troops
+
+    def begin_next_turn(self) -> int:
+        """Ends the current turn and starts the next one. Returns the seat whose turn it is."""
+        while True:
+            self.active_player = (self.active_player + 1) % len(self.player_ids)
+            if self.active_player not in self.eliminated_players:
+                break
+        seat = self.active_player
+
+        if self.in_pregame:
+            if self.deployable_troops[seat] == 0:
+                self.in_pregame = False
+            else:
+                return seat
+
+        self.deployable_troops[seat] = self.calculate_new_troops(seat)
+        self.turn_stage = 1 if len(self.cards[seat]) < 5 else 0
+        self.last_attack = None
+        self.card_claimed = False
+        return seat
+
+    def end_turn(self) -> dict:
+        """Ends the current turn. Returns the "next_player"."""
+        return {"next_player" : self.begin_next_turn()}
+
+    def deploy(self, seat: int, territory: int, troops: int) -> dict:
+        """Deploys troops onto a territory, claiming it if it's unclaimed. Returns whether that "turn_ended"."""
+        self.deployable_troops[seat] -= troops
+        self.troops[territory] += troops
+        if self.owners[territory] < 0:
+            self.owners[territory] = seat
+            self.unclaimed_territories -= 1
+            self.holdings[seat] |= 1 << territory
+
+        if self.in_pregame:
+            self.begin_next_turn()
+            return {"turn_ended" : True}
+        if self.deployable_troops[seat] == 0:
+            self.turn_stage = 2
+        return {"turn_ended" : False}
+
+    def attack(
+        self,
+        seat: int,
+        target: int,
+        attacker: int,
+        army_size: int,
+        off_dice: list[int],
+        def_dice: list[int],
+        deck: list[int] = None
+    ) -> dict:
+        """Resolves an attack with the given dice. Returns the same as engine.attack, with the eliminated player as
+        a seat, and the reshuffled "deck" as card ints (which, passed back in, reproduce the shuffle)."""
+        result = {"off_dead" : 0, "def_dead" : 0, "conquered" : False, "eliminated" : None, "victory" : False, "card" : False, "deck" : None}
+        for off_die, def_die in zip(off_dice, def_dice):
+            if off_die > def_die: result["def_dead"] += 1
+            else: result["off_dead"] += 1
+        self.troops[attacker] -= result["off_dead"]
+        self.troops[target] -= result["def_dead"]
+        self.last_attack = (target, attacker, army_size)
+
+        if self.troops[target] == 0:
+            result["conquered"] = True
+
+            # Transfer ownership and troops
+            defender = self.owners[target]
+            self.holdings[defender] &= ~(1 << target)
+            self.holdings[seat] |= 1 << target
+            self.owners[target] = seat
+            self.troops[target] = army_size
+            self.troops[attacker] -= army_size
+
+            # Eliminate the defender if they're out of turf
+            if self.holdings[defender] == 0:
+                self.discard_pile += self.cards[defender]
+                self.cards[defender] = None
+                self.eliminated_players.append(defender)
+                result["eliminated"] = defender
+
+            if self.holdings[seat] == TOPOLOGY[self.map]["all"]:
+                result["victory"] = True
+                return result
+
+            if self.troops[attacker] - 1 < 1:
+                self.last_attack = None
+
+            # Giving a card if no card has been claimed this turn, reshuffling if necessary
+            if not self.card_claimed:
+                if len(self.deck) == 0:
+                    if deck is None:
+                        deck = list(self.discard_pile)
+                        r.shuffle(deck)
+                    self.deck = list(deck)
+                    self.discard_pile = []
+                    result["deck"] = deck
+                self.cards[seat].append(self.deck.pop())
+                self.card_claimed = True
+                result["card"] = True
+
+        elif self.troops[attacker] == 1:
+            self.last_attack = None
+
+        return result
+
+    def advance(self, troops: int) -> dict:
+        """Moves troops from the last attack's attacking territory into the territory it just conquered.
+        Returns the "troops" the conquered territory now has."""
+        target, attacker, _ = self.last_attack
+        self.troops[attacker] -= troops
+        self.troops[target] += troops
+        self.last_attack = None
+        return {"troops" : self.troops[target]}
+
+    def has_path(self, seat: int, start: int, destination: int) -> bool:
+        """Returns whether a player owns a chain of adjacent territories leading from start to destination."""
+        return bool(TOPOLOGY[self.map]["adjacency"][start] & components(self.map, self.holdings[seat])[destination])
+
+    def move(self, start: int, destination: int, troops: int) -> dict:
+        """Makes the end-of-turn troop movement and starts the next turn. Returns the "next_player"."""
+        self.troops[start] -= troops
+        self.troops[destination] += troops
+        return {"next_player" : self.begin_next_turn()}
+
+    def trade(self, seat: int, cards: list[int]) -> dict:
+        """Trades in a set of cards. Returns the "new_troops", and the "bonus_territory" that received two more
+        for matching one of the cards, or None."""
+        bonus_territory = None
+        for card in cards:
+            territory = (card >> 2) - 1
+            if bonus_territory is None and territory >= 0 and self.holdings[seat] >> territory & 1:
+                bonus_territory = territory
+            self.cards[seat].remove(card)
+            self.discard_pile.append(card)
+
+        new_troops = TRADE_VALUES[self.trade_count] if self.trade_count < len(TRADE_VALUES) else (self.trade_count - 2) * 5
+        self.deployable_troops[seat] += new_troops
+        if bonus_territory is not None:
+            self.troops[bonus_territory] += 2
+        self.trade_count += 1
+        if self.turn_stage == 0:
+            self.turn_stage = 1
+        return {"new_troops" : new_troops, "bonus_territory" : bonus_territory}
+
+    def resign(self, seat: int) -> dict:
+        """Removes a player from the game. Returns the "winner" if that leaves only one player, otherwise None."""
+        self.discard_pile += self.cards[seat]
+        self.cards[seat] = None
+        self.eliminated_players.append(seat)
+
+        if len(self.player_ids) == len(self.eliminated_players) + 1:
+            return {"winner" : self.begin_next_turn()}
+
+        # Every player gets 5 troops for a resignation in the pregame. (engine.resign checks player ids against
+        # turn numbers here, so the resigned and the eliminated get them too; this does the same.)
+        if self.in_pregame:
+            for other in range(len(self.player_ids)):
+                self.deployable_troops[other] += 5
+        if self.active_player == seat:
+            self.begin_next_turn()
+        return {"winner" : None}
+
+    def hand(self, seat: int) -> list[tuple]:
+        """Returns a player's cards as the (type, territory) tuples that cards.best_set takes."""
+        return [decode_card(code, TOPOLOGY[self.map]["names"]) for code in self.cards[seat]]
+
+    def owned(self, seat: int) -> set:
+        """Returns the names of the territories a player owns."""
+        names = TOPOLOGY[self.map]["names"]
+        held = self.holdings[seat]
+        return {names[i] for i in range(len(names)) if held >> i & 1}
+
+    def territories(self, seat: int) -> list[int]:
+        """Returns the ids of a player's territories."""
+        held = self.holdings[seat]
+        return [i for i in range(len(self.owners)) if held >> i & 1]
+
+    def enemies(self, seat: int, territory: int) -> list[int]:
+        """Returns the ids of the territories next to a territory that someone else owns."""
+        return [i for i in TOPOLOGY[self.map]["neighbours"][territory] if self.owners[i] != seat]
+
+
+# Keys of a game dict that a GameState keeps in its own slots
+_GAME_KEYS = (
+    "players", "map", "territories", "deck", "discard_pile", "turn_order", "active_player", "eliminated_players",
+    "turn_stage", "in_pregame", "unclaimed_territories", "last_attack", "card_claimed", "trade_count", "active"
+)
@@ -1,120 +1,32 @@
 from discord import Client, File, Intents
-from display import draw_map
-from maps import MAPS
-import db_connector as db
+from discord.utils import setup_logging
+from display import MAP_FILENAME, MESSAGE_LIMIT, draw_text_map, turn_boards
+from render_pool import draw_map, draw_replay
+from engine import generate_new_game_data, begin_next_player_turn
+from cards import best_set, is_legal
+from maps import MAPS, adjacent
+from odds import odds, build as build_odds
+from copy import deepcopy
+from types import SimpleNamespace
+import db_async as db
+import engine
+import render_pool
+import ai
+import asyncio
+import logging
 import random as r
-import itertools
 
 intents = Intents.default()
 intents.message_content = True
 client = Client(intents=intents)
 
 
-def generate_new_game_data(
-    players: list[int],
-    map: str = "classic",
-    randomfill: bool = False
-) -> dict:
-    """Creates and returns a dictionary with game data."""
-    game = {}
-    map_data = MAPS[map]
-
-    # Initializing players
-    deployable_troops = 0 if randomfill else (40, 35, 30, 25, 20)[len(players)-2]
-    r.shuffle(players)
-    game["players"] = {
-        str(player_id) : { # JSON doesn't allow integer keys; pain ensues
-            "turn_number" : i+1,
-            "colour" : ("red", "blue", "yellow", "green", "brown", "black")[i],
-            "territories" : [],
-            "cards" : [],
-            "deployable_troops" : deployable_troops
-        } for i, player_id in enumerate(players)
-    }
-
-    # Initializing territories
-    game["map"] = map
-    game["territories"] = {
-        key : {"owner" : None, "troops" : 0}
-        for key in map_data["connections"].keys()
-    }
-    if randomfill:
-        for t_name, t_data in game["territories"].items():
-            lucky_player = r.choice(players)
-            t_data["owner"] = lucky_player
-            t_data["troops"] = r.randint(1, 10)
-            game["players"][str(lucky_player)]["territories"].append(t_name)
-        player = game["players"][str(players[0])]
-        player["deployable_troops"] = calculate_new_troops(game, str(players[0]))
-
-    # Initializing deck and discard pile
-    territory_names = [_ for _ in map_data["connections"].keys()]
-    r.shuffle(territory_names)
-    game["deck"] = [("Wild", None), ("Wild", None)] + [
-        (("Infantry", "Cavalry", "Artillery")[i%3], territory_names[i])
-        for i in range(len(territory_names))
-    ]
-    r.shuffle(game["deck"])
-    game["discard_pile"] = []
-            
-    # Other game variables
-    game["turn_order"] = players.copy()
-    game["active_player"] = 1
-    game["eliminated_players"] = []
-    game["turn_stage"] = 1
-    game["in_pregame"] = False if randomfill else True
-    game["unclaimed_territories"] = 0 if randomfill else len(territory_names)
-    game["last_attack"] = None
-    game["card_claimed"] = False
-    game["trade_count"] = 0
-    game["active"] = True
-
-    return game
-
-
-def calculate_new_troops(game: dict, player_id: int) -> int:
-    """Calculates the number of new troops a player would receive."""
-    player_territories = game["players"][str(player_id)]["territories"]
-
-    #The number of territories you occupy.
-    new_troops = len(player_territories) // 3
-    if new_troops < 3: new_troops = 3
-
-    #The value of the continents you control.
-    for continent in MAPS[game["map"]]["continents"]:
-        if continent["territories"].issubset(player_territories):
-            new_troops += continent["bonus"]
-        
-    return new_troops
-
-
-def begin_next_player_turn(game: dict) -> str:
-    """Ends current turn, starts next turn. Returns the id of the player whose turn it is."""
-    # Start by cycling active_player status to the next player
-    while True:
-        game["active_player"] += 1
-        if game["active_player"] > len(game["players"]):
-            game["active_player"] = 1
-        if game["active_player"] in game["eliminated_players"]:
-            continue
-        break
-
-    player_id = game["turn_order"][game["active_player"]-1]
-    player = game["players"][str(player_id)]
-
-    # Handle pregame scenarios
-    if game["in_pregame"]:
-        if player["deployable_troops"] == 0:
-            game["in_pregame"] = False
-        else:
-            return player_id
-    
-    player["deployable_troops"] = calculate_new_troops(game, player_id)
-    game["turn_stage"] = 1 if len(player["cards"]) < 5 else 0
-    game["last_attack"] = None
-    game["card_claimed"] = False
-
-    return player_id
+def mention(game: dict, player_id) -> str:
+    """Returns how to refer to a player in a message: a mention, or a name for computer players."""
+    computers = game.get("ai_players", {})
+    if str(player_id) not in computers:
+        return f"<@{player_id}>"
+    return f"AI {list(computers).index(str(player_id)) + 1} ({computers[str(player_id)]})"
 
 
 def generate_turn_start_message(game: dict) -> str:
@@ -124,15 +36,156 @@ def generate_turn_start_message(game: dict) -> str:
     s = "s" if troops > 1 else ""
 
     if game["in_pregame"]:
-        message = f"It's your turn to deploy, <@{player_id}>. You have {troops} troop{s} remaining."
+        message = f"It's your turn to deploy, {mention(game, player_id)}. You have {troops} troop{s} remaining."
     else:
-        message = f"It's your turn, <@{player_id}>; you have {troops} new troop{s} ready to be deployed."
+        message = f"It's your turn, {mention(game, player_id)}; you have {troops} new troop{s} ready to be deployed."
         if game["turn_stage"] == 0:
             message += " But you have too many cards and must trade in a set before proceeding with your turn." 
     
     return message
 
 
+async def send_with_map(channel, content: str, game: dict, mode: str = None) -> None:
+    """Sends a message along with the board, drawn as an image or, in text mode, written out as text.
+    The mode defaults to the game's own setting (see !map)."""
+    if (mode or game.get("map_mode", "image")) == "image":
+        await channel.send(content, file=File(await draw_map(game), MAP_FILENAME))
+        return
+    board = draw_text_map(game)
+    if content and len(content) + len(board) + 2 > MESSAGE_LIMIT:
+        await channel.send(content)
+        content = None
+    if len(board) <= MESSAGE_LIMIT:
+        await channel.send(f"{content}\n\n{board}" if content else board)
+        return
+    # Boards of big maps go out in as many code blocks as it takes
+    chunk = []
+    for line in board.strip("`\n").split("\n"):
+        if sum(len(l) + 1 for l in chunk) + len(line) + 8 > MESSAGE_LIMIT:
+            await channel.send("```\n" + "\n".join(chunk) + "\n```")
+            chunk = []
+        chunk.append(line)
+    await channel.send("```\n" + "\n".join(chunk) + "\n```")
+
+
+async def start_game(channel, game_id: int, invitation: dict) -> None:
+    """Starts a game once everyone invited has joined, and announces it."""
+    game = generate_new_game_data(invitation["players"], invitation["map"], invitation["randomfill"])
+    for key in ("ai_players", "guild_id"):
+        if key in invitation:
+            game[key] = invitation[key]
+    await db.update_game(game_id, game, checkpoint=True, event=("start", {}))
+    announcement = f"New game created with id {game_id}.\n"
+    for i, player in enumerate(game["players"], 1):
+        colour = ("red", "blue", "yellow", "green", "brown", "black")[i-1]
+        announcement += f"Player {i} ({colour}): {mention(game, player)}\n"
+    await send_with_map(channel, announcement + "\n" + generate_turn_start_message(game), game)
+
+
+class DeferredChannel:
+    """Stands in for a channel, holding on to everything sent to it until deliver is called."""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.messages = []
+
+    async def send(self, *args, **kwargs) -> None:
+        self.messages.append((args, kwargs))
+
+    async def deliver(self) -> None:
+        messages, self.messages = self.messages, []
+        for args, kwargs in messages:
+            await self.channel.send(*args, **kwargs)
+
+
+# One lock per guild, held while a command runs, so that two commands never read and write the same game at
+# the same time. Every game belongs to one guild, and commands like !join and !decline touch someone else's game.
+_command_locks = {}
+
+def command_lock(guild_id: int) -> asyncio.Lock:
+    """Returns the lock that a guild's commands take turns with."""
+    return _command_locks.setdefault(guild_id, asyncio.Lock())
+
+
+async def run_command(message) -> None:
+    """Handles a message as one unit of work: everything it writes is committed in one go, or not at all if it
+    fails. What it sends only goes out once that's done, so that nobody is told about a move that didn't stick."""
+    channel = DeferredChannel(message.channel)
+    async with command_lock(message.guild.id):
+        async with db.unit_of_work():
+            await handle_message(SimpleNamespace(
+                author=message.author, guild=message.guild, channel=channel, content=message.content, mentions=message.mentions
+            ))
+        await channel.deliver()
+
+
+# Games whose computer players are playing right now
+_playing = set()
+
+async def play_ai_turns(channel, guild, game_id: int) -> None:
+    """Plays the turns of computer players in a game for as long as it's one of their turns, up to
+    ai.MAX_TURNS_PER_COMMAND turns. Each turn is planned in one of ai's processes, then played one command at a
+    time through handle_message, just as if the computer player had typed the commands, so that they go through
+    the same checks as everyone else's. Games left with only computer players in them are called off."""
+    if game_id is None or game_id in _playing:
+        return
+    _playing.add(game_id)
+    try:
+        for _ in range(ai.MAX_TURNS_PER_COMMAND):
+            game = await db.get_game_data(game_id)
+            if game is None or "ai_players" not in game:
+                return
+            # Games with nobody else to wait for start straight away
+            if not game["active"]:
+                if False not in game["joined"]:
+                    deferred = DeferredChannel(channel)
+                    async with command_lock(guild.id):
+                        async with db.unit_of_work():
+                            await start_game(deferred, game_id, game)
+                        await deferred.deliver()
+                    continue
+                return
+            # Nobody would be around to see computer players play each other to the end
+            humans = [
+                player for player, data in game["players"].items()
+                if player not in game["ai_players"] and data["turn_number"] not in game["eliminated_players"]
+            ]
+            if not humans:
+                async with command_lock(guild.id):
+                    async with db.unit_of_work():
+                        await db.clear_game_pointers(game_id)
+                        await db.delete_game(game_id)
+                    await channel.send(f"Only computer players are left in game {game_id}, so it's been called off.")
+                return
+            player_id = str(game["turn_order"][game["active_player"]-1])
+            level = game["ai_players"].get(player_id)
+            if level is None:
+                return
+
+            policy = None if game["in_pregame"] else await ai.plan_turn(deepcopy(game), level)
+            author = SimpleNamespace(id=int(player_id), mention=mention(game, player_id))
+            for _ in range(ai.MAX_COMMANDS):
+                game = await db.get_game_data(game_id)
+                if game is None or str(game["turn_order"][game["active_player"]-1]) != player_id:
+                    break
+                command = ai.next_command(game, policy)
+                event_count = game.get("event_count")
+                await run_command(SimpleNamespace(author=author, guild=guild, channel=channel, content=command, mentions=[]))
+                # Every command that goes through is logged as an event; one that didn't would only be asked for again
+                if game.get("event_count") == event_count:
+                    logging.warning("Computer player %s in game %s was refused %r; resigning it", player_id, game_id, command)
+                    await run_command(SimpleNamespace(author=author, guild=guild, channel=channel, content="!resign", mentions=[]))
+                    break
+                if game["in_pregame"]:
+                    break
+        else:
+            game = await db.get_game_data(game_id)
+            if game is not None and str(game["turn_order"][game["active_player"]-1]) in game.get("ai_players", {}):
+                await channel.send("The computer players are taking a breather; send any command to have them carry on.")
+    finally:
+        _playing.discard(game_id)
+
+
 # Configuring the bot commands
 @client.event
 async def on_ready():
@@ -140,12 +193,21 @@ async def on_ready():
 
 @client.event
 async def on_message(message):
+    # The author's game is looked up first, since the command may well take them out of it
+    is_command = message.author != client.user and message.content.startswith("!")
+    game_id = await db.get_user_game_id(message.author.id, message.guild.id) if is_command else None
+    await run_command(message)
+    # Then any computer players whose turn it's become take theirs
+    if is_command:
+        await play_ai_turns(message.channel, message.guild, game_id or await db.get_user_game_id(message.author.id, message.guild.id))
+
+async def handle_message(message):
     # Ignore the bot's own messages
     if message.author == client.user:
         return
     # Rigged!
     if "rigged" in message.content.lower():
-        await message.channel.send(f"#{db.increment_rigged_counter()}")
+        await message.channel.send(f"#{await db.increment_rigged_counter()}")
     # Ignore messages without the prefix
     if message.content[0] != "!":
         return
@@ -169,23 +231,28 @@ async def on_message(message):
             command = args[0]
 
 
-    # Starts a new game including the message sender and all mentioned players.
+    # Starts a new game including the message sender, all mentioned players, and a computer player for each "ai:(level)".
     if command == "play":
         
         # Check you're not already in a game
-        if db.get_user_game_id(author_id, guild_id):
+        if await db.get_user_game_id(author_id, guild_id):
             await message.channel.send("You're already in a game on this server.")
             return
 
         # Finding the users mentioned in the message in order to add them to the game
         players = message.mentions.copy()
-        for mention in players:
-            if message.author == mention:
-                players.remove(mention)
-        if len(players) == 0:
+        for user in players:
+            if message.author == user:
+                players.remove(user)
+        # And the computer players asked for
+        levels = [arg[3:].lower() for arg in args[1:] if arg.lower().startswith("ai:")]
+        if any(level not in ai.LEVELS for level in levels):
+            await message.channel.send(f"There's no such AI level; choose from {', '.join(ai.LEVELS)} (e.g. ai:hard).")
+            return
+        if len(players) + len(levels) == 0:
             await message.channel.send("Unfortunately you cannot play by yourself.")
             return
-        if len(players) > 5:
+        if len(players) + len(levels) > 5:
             await message.channel.send("Too many players; the maximum is 6.")
             return
         # Turning the player list into a player id list
@@ -194,7 +261,7 @@ async def on_message(message):
         # Checking to make sure none of the players are already in a game
         busy_players = []
         for player in players:
-            if db.get_user_game_id(player, guild_id) != None:
+            if await db.get_user_game_id(player, guild_id) != None:
                 busy_players.append(f"<@{player}>")
         if busy_players:
             # Formatting the message
@@ -211,21 +278,37 @@ async def on_message(message):
             return
 
         # Creating a game in the inactive state
-        game_map = args[1].lower if args[1].lower in list(MAPS.keys()) else "classic"
-        game_id = db.create_game({
-            "players" : [str(player) for player in players] + [str(author_id)],
-            "joined" : [False] * len(players) + [True],
+        game_map = args[1].lower() if args[1].lower() in MAPS else "classic"
+        # Loading the map now, so that a broken map file is caught before anyone plays on it
+        try:
+            MAPS[game_map]
+        except ValueError as error:
+            await message.channel.send(f"That map can't be played: {error}")
+            return
+        # Computer players get made-up negative ids, which can't clash with anyone's, and have already joined
+        computers = [str(-r.randrange(1, 2**62)) for _ in levels]
+        game = {
+            "players" : [str(player) for player in players] + computers + [str(author_id)],
+            "joined" : [False] * len(players) + [True] * len(computers) + [True],
             "active" : False,
             "map" : game_map,
-            "randomfill" : bool(args[-1] == "randomfill")
-        })
-        # Updating game creator's current game
-        db.ensure_user_exists(author_id, guild_id)
-        db.update_user_game_pointer(author_id, guild_id, game_id)
-
-        # Announcing
-        players = ", ".join([f"<@{player}>" for player in players])
-        await message.channel.send(f"Invited {players} to a game on the {game_map.title()} map.")
+            "randomfill" : bool(args[-1] == "randomfill"),
+            "guild_id" : guild_id
+        }
+        if computers:
+            game["ai_players"] = dict(zip(computers, levels))
+        game_id = await db.create_game(game)
+        # Updating game creator's and computer players' current game
+        for player in [author_id] + [int(computer) for computer in computers]:
+            await db.ensure_user_exists(player, guild_id)
+            await db.update_user_game_pointer(player, guild_id, game_id)
+
+        # Announcing (games with only computer players to wait for start once this is saved)
+        invited = ", ".join([mention(game, player) for player in game["players"][:-1]])
+        if players:
+            await message.channel.send(f"Invited {invited} to a game on the {game_map.title()} map.")
+        else:
+            await message.channel.send(f"Setting up a game against {invited} on the {game_map.title()} map...")
         return
 
 
@@ -233,7 +316,7 @@ async def on_message(message):
     if command == "join":
 
         # Check user isn't already in a game
-        if db.get_user_game_id(author_id, guild_id) is not None:
+        if await db.get_user_game_id(author_id, guild_id) is not None:
             await message.channel.send("You're already in a game on this server.")
             return
         # Check for malformed arguments
@@ -243,7 +326,7 @@ async def on_message(message):
             await message.channel.send("I'm not sure whose game you're trying to join.")
             return
         # Check the game exists
-        game = db.get_user_game_data(gamemaster_id, guild_id)
+        game = await db.get_user_game_data(gamemaster_id, guild_id)
         if game is None:
             await message.channel.send("That game doesn't exist.")
             return
@@ -257,31 +340,21 @@ async def on_message(message):
             return
 
         # Updating user's game pointer
-        game_id = db.get_user_game_id(gamemaster_id, guild_id)
-        db.ensure_user_exists(author_id, guild_id)
-        db.update_user_game_pointer(author_id, guild_id, game_id)
+        game_id = await db.get_user_game_id(gamemaster_id, guild_id)
+        await db.ensure_user_exists(author_id, guild_id)
+        await db.update_user_game_pointer(author_id, guild_id, game_id)
 
         # Updating local game variable, not updating database just yet
         game["joined"][game["players"].index(str(author_id))] = True
 
         # If some players still need to join, update database and return
         if False in game["joined"]:
-            db.update_game(game_id, game)
+            await db.update_game(game_id, game)
             await message.channel.send(f"Joined {args[1]}'s game.")
             return
         
         # Otherwise, start the game!
-        game = generate_new_game_data(game["players"], game["map"], game["randomfill"])
-        db.update_game(game_id, game)
-        announcement = f"New game created with id {game_id}.\n"
-        for i, player in enumerate(game["players"], 1):
-            colour = ("red", "blue", "yellow", "green", "brown", "black")[i-1]
-            announcement += f"Player {i} ({colour}): <@{player}>\n"
-        starting_player = [player for player in game["players"].keys()][0]
-        await message.channel.send(
-            announcement + "\n" + generate_turn_start_message(game),
-            file=File(draw_map(game), "map.jpg")
-        )
+        await start_game(message.channel, game_id, game)
         return
 
 
@@ -295,7 +368,7 @@ async def on_message(message):
             await message.channel.send("I'm not sure whose invitation you're trying to decline.")
             return
         # Check the game exists
-        game = db.get_user_game_data(gamemaster_id, guild_id)
+        game = await db.get_user_game_data(gamemaster_id, guild_id)
         if game is None:
             await message.channel.send("That game doesn't exist.")
             return
@@ -303,17 +376,21 @@ async def on_message(message):
         if str(author_id) not in game["players"]:
             await message.channel.send("You weren't invited.")
             return
+        # Check that the game is still waiting on invites, and on this user in particular
+        if game["active"]:
+            await message.channel.send("That game has already started; use !resign instead.")
+            return
+        if game["joined"][game["players"].index(str(author_id))]:
+            await message.channel.send("You've already joined that game; use !leave instead.")
+            return
 
         # Resetting joined players' game pointers and deleting the game
-        game_id = db.get_user_game_id(author_id, guild_id)
-        players = game["players"]
-        for i, player in enumerate(players):
-            if game["joined"][i]:
-                db.update_user_game_pointer(player, guild_id, None)
-        db.delete_game(game_id)
+        game_id = await db.get_user_game_id(gamemaster_id, guild_id)
+        await db.clear_game_pointers(game_id)
+        await db.delete_game(game_id)
         
         # Announcing deletion
-        players = [f"<@{player}>" for player in players]
+        players = [mention(game, player) for player in game["players"]]
         await message.channel.send(f"{', '.join(players)}\n\n<@{author_id}> has declined the invitation; the game hosted by {players[-1]} has been cancelled.")
         return
 
@@ -322,7 +399,7 @@ async def on_message(message):
     if command == "leave":
 
         # Check user is in a game
-        game = db.get_user_game_data(author_id, guild_id)
+        game = await db.get_user_game_data(author_id, guild_id)
         if game is None:
             await message.channel.send("You're not in a game on this server.")
             return
@@ -332,15 +409,12 @@ async def on_message(message):
             return
         
         # Resetting joined players' game pointers and deleting the game
-        game_id = db.get_user_game_id(author_id, guild_id)
-        players = game["players"]
-        for i, player in enumerate(players):
-            if game["joined"][i]:
-                db.update_user_game_pointer(player, guild_id, None)
-        db.delete_game(game_id)
+        game_id = await db.get_user_game_id(author_id, guild_id)
+        await db.clear_game_pointers(game_id)
+        await db.delete_game(game_id)
         
         # Announcing deletion
-        players = [f"<@{player}>" for player in players]
+        players = [mention(game, player) for player in game["players"]]
         await message.channel.send(f"{', '.join(players)}\n\n<@{author_id}> has left the game; the game hosted by {players[-1]} has been cancelled.")
         return
 
@@ -349,7 +423,7 @@ async def on_message(message):
     if command == "deploy":
         
         # Check user is in game
-        game = db.get_user_game_data(author_id, guild_id)
+        game = await db.get_user_game_data(author_id, guild_id)
         if game == None:
             await message.channel.send(f"You're not in a game, <@{author_id}>.")
             return
@@ -400,7 +474,7 @@ async def on_message(message):
             await message.channel.send(f"Couldn't find the territory '{key}'.")
             return
         # Get off my property
-        if territory["owner"] not in ("None", str(author_id)):
+        if territory["owner"] not in (None, str(author_id)):
             await message.channel.send("Someone else owns that territory.")
             return
         # Must claim territories while there are territories to be claimed
@@ -409,35 +483,35 @@ async def on_message(message):
             return
 
         # Deploying troops
-        game["players"][str(author_id)]["deployable_troops"] -= deployed_troops
-        territory["troops"] += deployed_troops
-        if territory["owner"] == None:
-            territory["owner"] = str(author_id)
-            game["unclaimed_territories"] -= 1
-            game["players"][str(author_id)]["territories"].append(deploy_location)
-
-        # Resolving post-deployment game logic; making the appropriate announcements
+        turn_ended = engine.deploy(game, str(author_id), deploy_location, deployed_troops)
+
+        # Making the appropriate announcements
         announcement = f"Deployed {deployed_troops} troop{'s' if deployed_troops > 1 else ''} to {deploy_location}."
-        file = None
-        # End turn if deploying in pregame
-        if game["in_pregame"]:
-            begin_next_player_turn(game)
+        show_map = False
+        if turn_ended:
             announcement += "\n\n" + generate_turn_start_message(game)
-            file = File(draw_map(game), "map.jpg")
-        # If not in pregame and all troops deployed, enable attacking
-        elif game["players"][str(author_id)]["deployable_troops"] == 0:
-            game["turn_stage"] = 2
+            show_map = True
+        elif game["turn_stage"] == 2:
             announcement += "\n\nAll troops deployed. Attack as you please, general."
-            file = File(draw_map(game), "map.jpg")
-        db.update_user_game_data(author_id, guild_id, game)
-        await message.channel.send(announcement, file=file)
+            show_map = True
+        event = ("deploy", {"player" : str(author_id), "territory" : deploy_location, "troops" : deployed_troops})
+        await db.update_user_game_data(author_id, guild_id, game, checkpoint=turn_ended, event=event)
+        if show_map:
+            await send_with_map(message.channel, announcement, game)
+        else:
+            await message.channel.send(announcement)
         return
 
 
-    # Triggers an attack.
+    # Triggers an attack. "!blitz", or "!attack ... blitz", keeps attacking until the territory falls or the army runs out.
+    blitz = command == "blitz" or (command == "attack" and args[-1].lower() == "blitz")
+    if blitz:
+        command = "attack"
+        if args[-1].lower() == "blitz":
+            args.pop()
     if command == "attack":
 
-        game = db.get_user_game_data(author_id, guild_id)
+        game = await db.get_user_game_data(author_id, guild_id)
         # Check user is in game
         if game == None:
             await message.channel.send(f"You're not in a game, <@{author_id}>.")
@@ -480,14 +554,14 @@ async def on_message(message):
             target
         # Plenty of NameError baiting in the above code
         except (NameError, ValueError):
-            await message.channel.send("Invalid syntax. Usage: !attack (target country) from (attacking country) [with (army size)]\n(e.g. !attack Siam from Indonesia with 2)")
+            await message.channel.send("Invalid syntax. Usage: !attack (target country) from (attacking country) [with (army size)] [blitz]\n(e.g. !attack Siam from Indonesia with 2)")
             return
         # Might be using the shortcut
         except IndexError:
             if game["last_attack"]:
                 target, attacker, army_size = game["last_attack"]
             else:
-                await message.channel.send("Usage: !attack (target country) from (attacking country) [with (army size)]\n(e.g. !attack Siam from Indonesia with 2)\nAlternatively, !attack can be used on its own to repeat your previous attack. If you were attempting this, know that no previous attack was found.")
+                await message.channel.send("Usage: !attack (target country) from (attacking country) [with (army size)] [blitz]\n(e.g. !attack Siam from Indonesia with 2)\nAlternatively, !attack can be used on its own to repeat your previous attack. If you were attempting this, know that no previous attack was found.")
                 return
         # Make sure army_size is assigned
         try: army_size
@@ -501,7 +575,7 @@ async def on_message(message):
             await message.channel.send(f"Couldn't find the territory '{key}'.")
             return
         # Check territories are adjacent
-        if target not in MAPS[game["map"]]["connections"][attacker]:
+        if not adjacent(game["map"], attacker, target):
             await message.channel.send("Those territories are not adjacent.")
             return
         # Check user owns the attacking territory
@@ -530,61 +604,54 @@ async def on_message(message):
         if adjusted:
             await message.channel.send(f"Automatically reducing attacking army size to {army_size}...")
 
-        # Rolling the dice, counting the casualties
-        off_dice = [r.randint(1, 6) for _ in range(army_size)]
-        def_dice = [r.randint(1, 6) for _ in range(2 if def_territory["troops"] > 1 else 1)]
-        off_dice.sort(reverse=True)
-        def_dice.sort(reverse=True)
-        off_dead, def_dead = 0, 0
-        try:
-            for i in range(2):
-                if off_dice[i] > def_dice[i]: def_dead += 1
-                else: off_dead += 1
-        except IndexError: pass
-        off_territory["troops"] -= off_dead
-        def_territory["troops"] -= def_dead
-        game["last_attack"] = (target, attacker, army_size)
-
-        # Assembling results text
-        those_who_lost = "both armies" if off_dead and def_dead else "attackers" if off_dead else "defenders"
-        amount_text = "two troops" if 2 in (off_dead, def_dead) else "one troop"        
-        changes = "("
-        if those_who_lost != "defenders":
-            changes += f"{off_troops} -> {off_troops - off_dead}"
-            if those_who_lost == "both armies":
-                changes += ", "
-        if those_who_lost != "attackers":
-            changes += f"{def_troops} -> {def_troops - def_dead}"
-        changes += ")"
-        results = f"Rolling...\n`Attackers ({off_troops}): {off_dice}`\n`Defenders ({def_troops}): {def_dice}`\n`Result: {those_who_lost} lose {amount_text}. {changes}`"
+        event = {"player" : str(author_id), "target" : target, "attacker" : attacker, "army_size" : army_size}
+        if blitz:
+            # Rolling round after round in one go
+            outcome = engine.blitz(game, str(author_id), target, attacker, army_size)
+            off_dead, def_dead = outcome["off_dead"], outcome["def_dead"]
+            event["rolls"] = outcome["rolls"]
+            army_size = outcome["army_size"]
+            rounds = outcome["rounds"]
+            results = f"Blitzing...\n`{rounds} round{'s' if rounds > 1 else ''} of rolls: attackers lost {off_dead}, defenders lost {def_dead}. ({off_troops} -> {off_troops - off_dead}, {def_troops} -> {def_troops - def_dead})`"
+        else:
+            # Rolling the dice, counting the casualties
+            off_dice, def_dice = engine.roll_dice(army_size, def_troops)
+            outcome = engine.attack(game, str(author_id), target, attacker, army_size, off_dice, def_dice)
+            off_dead, def_dead = outcome["off_dead"], outcome["def_dead"]
+            event.update(off_dice=off_dice, def_dice=def_dice)
+
+            # Assembling results text
+            those_who_lost = "both armies" if off_dead and def_dead else "attackers" if off_dead else "defenders"
+            amount_text = "two troops" if 2 in (off_dead, def_dead) else "one troop"        
+            changes = "("
+            if those_who_lost != "defenders":
+                changes += f"{off_troops} -> {off_troops - off_dead}"
+                if those_who_lost == "both armies":
+                    changes += ", "
+            if those_who_lost != "attackers":
+                changes += f"{def_troops} -> {def_troops - def_dead}"
+            changes += ")"
+            results = f"Rolling...\n`Attackers ({off_troops}): {off_dice}`\n`Defenders ({def_troops}): {def_dice}`\n`Result: {those_who_lost} lose {amount_text}. {changes}`"
+        if outcome["deck"] is not None:
+            event["deck"] = outcome["deck"]
+        event = ("blitz" if blitz else "attack", event)
 
         # If territory was conquered...
-        if def_territory["troops"] == 0:
-
-            # Transfer ownership and troops
-            conquered_player_id = def_territory["owner"]
-            conquered_player = game["players"][str(conquered_player_id)]
-            conquered_player["territories"].remove(target)
-            player["territories"].append(target)
-            def_territory["owner"] = str(author_id)
-            def_territory["troops"] = army_size
-            off_territory["troops"] -= army_size
-
-            # Eliminate a player if he's out of turf
-            if len(conquered_player["territories"]) == 0:
-                game["discard_pile"] += conquered_player["cards"]
-                conquered_player["cards"] = None
-                game["eliminated_players"].append(conquered_player["turn_number"])
-                results += f"\n\n<@{conquered_player_id}> has been eliminated."
-                db.update_user_game_pointer(conquered_player_id, guild_id, None)
+        if outcome["conquered"]:
+
+            # Announcing eliminations
+            if outcome["eliminated"] is not None:
+                results += f"\n\n{mention(game, outcome['eliminated'])} has been eliminated."
+                await db.update_user_game_pointer(outcome["eliminated"], guild_id, None)
 
             # Check for victory and the game's end
-            if len(player["territories"]) == len(MAPS[game["map"]]["connections"]):
-                results += f"\n\nVICTORY! <@{author_id}> has conquered the world!"
-                game_id = db.get_user_game_id(author_id, guild_id)
-                db.update_user_game_pointer(author_id, guild_id, None)
-                db.delete_game(game_id)
-                await message.channel.send(results, file=File(draw_map(game), "map.jpg"))
+            if outcome["victory"]:
+                results += f"\n\nVICTORY! {mention(game, author_id)} has conquered the world!"
+                game_id = await db.get_user_game_id(author_id, guild_id)
+                await db.update_game(game_id, game, event=event)
+                await db.clear_game_pointers(game_id)
+                await db.delete_game(game_id)
+                await send_with_map(message.channel, results, game)
                 return
 
             # Announcing the territory ownership transfer and movement options
@@ -594,40 +661,71 @@ async def on_message(message):
                 results += f" But you can also type '!move' to move an additional 1 troop forward. (Doing some other move or attack will negate this opportunity.)"
             elif max_troops > 1:
                 results += f" But you can also type '!move' to move {max_troops} additional troops forward (the maximum), or '!move (number)' to move a specific, lesser number of additional troops forward. (Doing some other move or attack will negate this opportunity.)"
-            else:
-                game["last_attack"] = None
-
-            # Giving a card if no card has been claimed this turn
-            if not game["card_claimed"]:
-                # Shuffling if necessary
-                if len(game["deck"]) == 0:
-                    game["deck"] = [card for card in game["discard_pile"]]
-                    r.shuffle(game["deck"])
-                    game["discard_pile"] = []
-                player["cards"].append(game["deck"].pop())
-                game["card_claimed"] = True
+
+            # Announcing the card
+            if outcome["card"]:
                 results += "\n\nFor conquering a territory this turn, you also gained a card."
 
         # If user's army was crippled...
         elif off_territory["troops"] == 1:
-            game["last_attack"] = None
             results += f"\n\nYour army has grown too small to continue the attack."
 
-        # Update database
-        db.update_user_game_data(author_id, guild_id, game)
+        # Update database, writing through if someone was just eliminated
+        await db.update_user_game_data(author_id, guild_id, game, checkpoint=outcome["eliminated"] is not None, event=event)
 
         # Add map image to the message if something happened
-        file = None
         if def_territory["owner"] == str(author_id) or off_territory["troops"] == 1:
-            file=File(draw_map(game), "map.jpg")
-        await message.channel.send(results, file=file)
+            await send_with_map(message.channel, results, game)
+        else:
+            await message.channel.send(results)
+        return
+
+
+    # Works out the odds of attacking a territory until it falls or the attacking army runs out.
+    if command == "odds":
+
+        # Check user is in game
+        game = await db.get_user_game_data(author_id, guild_id)
+        if game == None:
+            await message.channel.send(f"You're not in a game, <@{author_id}>.")
+            return
+        # Parsing
+        try:
+            split = args.index("from")
+            target = " ".join(args[1:split]).title()
+            attacker = " ".join(args[split+1:]).title()
+            if not target or not attacker: raise ValueError
+        except ValueError:
+            await message.channel.send("Usage: !odds (target country) from (attacking country)\n(e.g. !odds Siam from Indonesia)")
+            return
+        # Check the territories are real
+        try:
+            off_troops = game["territories"][attacker]["troops"]
+            def_troops = game["territories"][target]["troops"]
+        except KeyError as key:
+            await message.channel.send(f"Couldn't find the territory '{key}'.")
+            return
+        # Check territories are adjacent
+        if not adjacent(game["map"], attacker, target):
+            await message.channel.send("Those territories are not adjacent.")
+            return
+
+        try:
+            win, attackers_left, defenders_left = odds(off_troops, def_troops)
+        except ValueError as error:
+            await message.channel.send(str(error))
+            return
+        await message.channel.send(
+            f"Attacking {target} ({def_troops}) from {attacker} ({off_troops}) until one side is spent:\n"
+            f"`Chance of conquering: {win:.1%}`\n`Expected troops left: {attackers_left:.1f} attacking, {defenders_left:.1f} defending`"
+        )
         return
 
 
     # Relocates troops after successful conquest or at the end of your turn.
     if command == "move":
         
-        game = db.get_user_game_data(author_id, guild_id)
+        game = await db.get_user_game_data(author_id, guild_id)
         # Check user is in a game
         if game == None:
             await message.channel.send(f"You're not in a game, <@{author_id}>.")
@@ -675,11 +773,9 @@ async def on_message(message):
                 await message.channel.send(move_command_syntax_error_message)
                 return
             # Update troop numbers and clear last_attack (to disallow further movement)
-            attacker_territory["troops"] -= troop_count
-            target_territory["troops"] += troop_count
-            game["last_attack"] = None
+            engine.advance(game, troop_count)
             # Update database and announce movement
-            db.update_user_game_data(author_id, guild_id, game)
+            await db.update_user_game_data(author_id, guild_id, game, event=("advance", {"troops" : troop_count}))
             await message.channel.send(f"Moved {troop_count} extra troop{'s' if troop_count > 1 else ''} to {target}, increasing its troop count to {target_territory['troops']}.")
             return
         
@@ -732,37 +828,20 @@ async def on_message(message):
             return
         
         # Check for a path between the territories
-        connections = MAPS[game["map"]]["connections"]
-        unexplored = [start]
-        examined = []
-        found_path = False
-        while not found_path and len(unexplored):
-            territory_name = unexplored.pop()
-            for connection in connections[territory_name]:
-                if connection in examined:
-                    continue
-                if game["territories"][connection]["owner"] == str(author_id):
-                    if connection == destination:
-                        found_path = True
-                        break
-                    else:
-                        unexplored.append(connection)
-                examined.append(connection)
-        if not found_path:
+        if not engine.has_path(game, str(author_id), start, destination):
             await message.channel.send("You don't own a path between those territories.")
             return
         
         # Transferring troops, starting the next player's turn, and updating database
-        territory_a["troops"] -= troop_count
-        territory_b["troops"] += troop_count
-        begin_next_player_turn(game)
-        db.update_user_game_data(author_id, guild_id, game)
+        engine.fortify(game, start, destination, troop_count)
+        event = ("move", {"start" : start, "destination" : destination, "troops" : troop_count})
+        await db.update_user_game_data(author_id, guild_id, game, checkpoint=True, event=event)
 
         # Announcing transferal the beginning of a new turn
         start_message = generate_turn_start_message(game)
         destination_troops = territory_b["troops"]
         await message.channel.send(f"Moved {troop_count} extra troops to {destination}, increasing its troop count to {destination_troops}.")
-        await message.channel.send(start_message, file=File(draw_map(game), "map.jpg"))
+        await send_with_map(message.channel, start_message, game)
         return
 
 
@@ -770,7 +849,7 @@ async def on_message(message):
     if command == "cards":
 
         # Check user is in game
-        game = db.get_user_game_data(author_id, guild_id)
+        game = await db.get_user_game_data(author_id, guild_id)
         if game == None:
             await message.channel.send(f"You're not in a game, <@{author_id}>.")
             return
@@ -799,7 +878,7 @@ async def on_message(message):
     if command == "trade":
 
         # Check user is in game
-        game = db.get_user_game_data(author_id, guild_id)
+        game = await db.get_user_game_data(author_id, guild_id)
         if game == None:
             await message.channel.send(f"You're not in a game, <@{author_id}>.")
             return
@@ -841,92 +920,77 @@ async def on_message(message):
             # All arguments recorded, moving on
             pass
 
-        # Just a helpful inner function
-        def check_set_legality(cards_to_be_checked):
-            legal = False
-            if len(cards_to_be_checked) == 3:
-                L = [card[0] for card in cards_to_be_checked]
-                L, wild = (L.count("Infantry"), L.count("Cavalry"), L.count("Artillery")), L.count("Wild")
-                if wild or L.count(2) == 0: legal = True
-            return legal
-
         # Legality checking and autoselecting
         if len(selected_cards) == 3:
-            if not check_set_legality(selected_cards):
+            if not is_legal(selected_cards):
                 await message.channel.send("That's not a legal set of cards.")
                 return
-        else: # Autoselecting
-            # Filling a list named legal_sets with all possible legal sets of cards
-            legal_sets = []
-            unselected_cards = [card for card in cards if card not in selected_cards]
-            for combination in itertools.combinations(unselected_cards, 3 - len(selected_cards)):
-                possible_set = selected_cards + list(combination)
-                if check_set_legality(possible_set):
-                    legal_sets.append(possible_set)
-            if not legal_sets:
+        else:
+            selected_cards = best_set(cards, selected_cards, set(player["territories"]))
+            if selected_cards is None:
                 await message.channel.send(f"You don't have a complete set to trade in, {message.author.mention}.")
                 return
 
-        # If we haven't selected yet, that means we have multiple legal sets to choose from
-        if len(selected_cards) != 3:
-            # Calculating set scores
-            scores = []
-            for legal_set in legal_sets:
-                score = 0
-                card_types = []
-                for card in legal_set:
-                    if card[0] == "Wild": card_types.append("Wild")
-                    elif card[1] in player["territories"]: card_types.append("Bonus")
-                    else: card_types.append("Normal")
-                # The criteria for the best set:
-                # 1. Set has a bonus card.
-                # 2. Set has a low number of wild cards.
-                # 3. Set has a low number of bonus cards.
-                if "Bonus" in card_types: score += 3
-                wilds = card_types.count("Wild")
-                if wilds:
-                    if wilds == 1: score += 1
-                else: score += 2
-                if score == 5: score += card_types.count("Normal")
-                scores.append(score)
-            # Picking the set with the best score
-            selected_cards = legal_sets[scores.index(max(scores))]
-
-        # Discarding cards and figuring out if there's a bonus territory
-        bonus_territory = None
-        for card in selected_cards:
-            if not bonus_territory and card[1] in player["territories"]:
-                bonus_territory = card[1]
-            cards.remove(card)
-            game["discard_pile"].append(card)
-
-        # Success! Have some troops
-        try: new_troops = (4, 6, 8, 10, 12, 15)[game["trade_count"]]
-        except IndexError: new_troops = ((game["trade_count"]-2)*5) #20, 25, 30...
-        player["deployable_troops"] += new_troops
-        if bonus_territory:
-            game["territories"][bonus_territory]["troops"] += 2
-        game["trade_count"] += 1
-        
-        # Allowing deployment if player was previously locked into a trade
-        if game["turn_stage"] == 0:
-            game["turn_stage"] = 1
+        # Discarding cards, collecting troops and allowing deployment if player was previously locked into a trade
+        new_troops, bonus_territory = engine.trade(game, str(author_id), selected_cards)
 
         # Updating database and announcing the acquisition
-        db.update_user_game_data(author_id, guild_id, game)
+        event = ("trade", {"player" : str(author_id), "cards" : selected_cards})
+        await db.update_user_game_data(author_id, guild_id, game, event=event)
         await message.channel.send(f"You've received {new_troops} extra troops and now have {player['deployable_troops']} troops left to deploy." + (f" (Additionally, for trading in a card marked with {bonus_territory}, a territory you own, two extra troops were deployed to {bonus_territory}.)" if bonus_territory else ""))
         return
 
 
-    # Displays the map.
+    # Displays the map, as an image or as text. "!map always text" (or image) changes how the game shows it from then on.
     if command == "map":
         # Check user is in game
-        game = db.get_user_game_data(author_id, guild_id)
+        game = await db.get_user_game_data(author_id, guild_id)
         if game == None:
             await message.channel.send(f"You're not in a game, <@{author_id}>.")
             return
+        # Check for a valid mode
+        always = len(args) > 1 and args[1].lower() == "always"
+        mode = args[2 if always else 1].lower() if len(args) > (2 if always else 1) else None
+        if mode not in (None, "image", "text") or (always and mode is None):
+            await message.channel.send("Usage: !map [text|image], or !map always (text|image) to change how your game's map is shown after every turn.")
+            return
+        # Changing the game's setting
+        if always:
+            game["map_mode"] = mode
+            await db.update_user_game_data(author_id, guild_id, game, event=("map_mode", {"mode" : mode}))
+            await message.channel.send(f"Your game's map will be shown as {'text' if mode == 'text' else 'an image'} from now on.")
+            return
         # Send the map
-        await message.channel.send(file=File(draw_map(game), "map.jpg"))
+        await send_with_map(message.channel, None, game, mode)
+        return
+
+
+    # Sends an animation of a game's map over the course of the game, turn by turn. Takes a game id for finished games.
+    if command == "replay":
+
+        # Finding the game
+        own_game_id = await db.get_user_game_id(author_id, guild_id)
+        try:
+            game_id = int(args[1]) if len(args) > 1 else own_game_id
+        except ValueError:
+            await message.channel.send("Usage: !replay [game id]")
+            return
+        if game_id is None:
+            await message.channel.send(f"You're not in a game, <@{author_id}>. To replay a finished game, use !replay (game id).")
+            return
+        # Check there's a history to replay
+        game = await db.replay_game(game_id, 0)
+        if game is None:
+            await message.channel.send("There's no history to replay for that game.")
+            return
+        # Other games can only be replayed by their players, in the server they were played in
+        if game_id != own_game_id and (game.get("guild_id", guild_id) != guild_id or str(author_id) not in game["players"]):
+            await message.channel.send("You can only replay games you played in this server.")
+            return
+
+        # Replaying the game and animating it, off the event loop and without loading its whole history at once
+        boards = await db.replay_history(game_id, game, turn_boards)
+        await message.channel.send(f"Game {game_id}, turn by turn:", file=File(await draw_replay(boards), "replay.gif"))
         return
 
 
@@ -934,7 +998,7 @@ async def on_message(message):
     if command == "endturn":
 
         # Check user is in game
-        game = db.get_user_game_data(author_id, guild_id)
+        game = await db.get_user_game_data(author_id, guild_id)
         if game == None:
             await message.channel.send(f"You're not in a game, <@{author_id}>.")
             return
@@ -951,8 +1015,8 @@ async def on_message(message):
         # Start next turn and update database
         begin_next_player_turn(game)
         start_message = generate_turn_start_message(game)
-        db.update_user_game_data(author_id, guild_id, game)
-        await message.channel.send(start_message, file=File(draw_map(game), "map.jpg"))
+        await db.update_user_game_data(author_id, guild_id, game, checkpoint=True, event=("endturn", {}))
+        await send_with_map(message.channel, start_message, game)
         return
 
 
@@ -960,48 +1024,67 @@ async def on_message(message):
     if command == "resign":
 
         # Check user is in game
-        game = db.get_user_game_data(author_id, guild_id)
+        game = await db.get_user_game_data(author_id, guild_id)
         if game == None:
             await message.channel.send(f"You're not in a game, <@{author_id}>.")
             return
         
         # Clean up data
         player = game["players"][str(author_id)]
-        game["discard_pile"] += player["cards"]
-        player["cards"] = None
-        game["eliminated_players"].append(player["turn_number"])
+        was_pregame = game["in_pregame"]
+        was_their_turn = game["active_player"] == player["turn_number"]
+        winner_id = engine.resign(game, str(author_id))
 
-        announcement = f"<@{author_id}> has resigned."
+        announcement = f"{mention(game, author_id)} has resigned."
 
         # Determine if game is over
-        game_over = False
-        if len(game["players"]) == len(game["eliminated_players"]) + 1:
-            winner_id = begin_next_player_turn(game)
-            announcement += f"\n\nVICTORY! <@{winner_id}> has conquered the world! (Or most of it, anyway.)"
-            db.update_user_game_pointer(winner_id, guild_id, None)
-            game_over = True
+        game_over = winner_id is not None
+        if game_over:
+            announcement += f"\n\nVICTORY! {mention(game, winner_id)} has conquered the world! (Or most of it, anyway.)"
         else:
-            # If it was still the deployment stage of the game, give each player 5 troops
-            if game["in_pregame"]:
+            if was_pregame:
                 announcement += " Everyone has been given 5 additional troops to deploy as compensation."
-                for nonquitter in game["players"].keys():
-                    if nonquitter not in game["eliminated_players"]:
-                        game["players"][str(nonquitter)]["deployable_troops"] += 5
-            # If it was the resigning player's turn, cycle active_player
-            if game["active_player"] == player["turn_number"]:
-                begin_next_player_turn(game)
+            if was_their_turn:
                 announcement += "\n\n" + generate_turn_start_message(game)
         
         # Updating database and announcing the resignation and its consequences
+        event = ("resign", {"player" : str(author_id)})
         if game_over:
-            db.delete_game(db.get_user_game_id(author_id, guild_id))
+            game_id = await db.get_user_game_id(author_id, guild_id)
+            await db.update_game(game_id, game, event=event)
+            await db.clear_game_pointers(game_id)
+            await db.delete_game(game_id)
         else:
-            db.update_user_game_data(author_id, guild_id, game)
-        db.update_user_game_pointer(author_id, guild_id, None)
-        await message.channel.send(announcement, file=File(draw_map(game), "map.jpg"))
+            await db.update_user_game_data(author_id, guild_id, game, checkpoint=True, event=event)
+            await db.update_user_game_pointer(author_id, guild_id, None)
+        await send_with_map(message.channel, announcement, game)
         return
 
 
-# Punch in the token and let it roll
-with open("token.txt") as file: TOKEN = file.read()
-client.run(TOKEN)
+async def run_bot(token: str) -> None:
+    """Runs the bot until it's closed, keeping the game cache flushed along the way and on the way out."""
+    # The odds table takes a moment to build, so it's built here, off the event loop, instead of by the first !odds
+    await asyncio.get_running_loop().run_in_executor(None, build_odds)
+    async with client:
+        flusher = asyncio.create_task(db.flush_periodically())
+        try:
+            await client.start(token)
+        finally:
+            flusher.cancel()
+            await db.flush()
+
+
+# Punch in the token and let it roll (render workers re-import this module, hence the guard)
+if __name__ == "__main__":
+    with open("token.txt") as file: TOKEN = file.read()
+    setup_logging()
+    render_pool.start()
+    try:
+        asyncio.run(run_bot(TOKEN))
+    except KeyboardInterrupt:
+        pass
+
+    # Let any outstanding database writes land before exiting
+    db.shutdown()
+    render_pool.shutdown()
+    ai.shutdown()
@@ -1,125 +1,204 @@
-MAPS = {
-    "classic" : {
-        "file" : "maps/classic.jpg",
-        "continents" : [
-            {
-                "name" : "North America",
-                "bonus" : 5,
-                "territories" : {"Alaska", "North West Territory", "Greenland", "Alberta", "Ontario", "Quebec", "Western United States", "Eastern United States", "Central America"}
-            },
-            {
-                "name" : "South America",
-                "bonus" : 2,
-                "territories" : {"Venezuela", "Peru", "Brazil", "Argentina"}
-            },
-            {
-                "name" : "Europe",
-                "bonus" : 5,
-                "territories" : {"Iceland", "Scandinavia", "Ukraine", "Great Britain", "Northern Europe", "Western Europe", "Southern Europe"}
-            },
-            {
-                "name" : "Africa",
-                "bonus" : 3,
-                "territories" : {"North Africa", "Egypt", "East Africa", "Congo", "South Africa", "Madagascar"}
-            },
-            {
-                "name" : "Asia",
-                "bonus" : 7,
-                "territories" : {"Ural", "Siberia", "Yakutsk", "Kamchatka", "Irkutsk", "Mongolia", "Japan", "Afghanistan", "China", "Middle East", "India", "Siam"}
-            },
-            {
-                "name" : "Australia",
-                "bonus" : 2,
-                "territories" : {"Indonesia", "New Guinea", "Western Australia", "Eastern Australia"}
-            }
-        ],
-        "connections" : {
-            "Alaska" : ("North West Territory", "Alberta", "Kamchatka"),
-            "North West Territory" : ("Alaska", "Alberta", "Ontario", "Greenland"),
-            "Greenland" : ("North West Territory", "Ontario", "Quebec", "Iceland"),
-            "Alberta" : ("Alaska", "North West Territory", "Ontario", "Western United States"),
-            "Ontario" : ("North West Territory", "Greenland", "Alberta", "Quebec", "Western United States", "Eastern United States"),
-            "Quebec" : ("Greenland", "Ontario", "Eastern United States"),
-            "Western United States" : ("Alberta", "Ontario", "Eastern United States", "Central America"),
-            "Eastern United States" : ("Ontario", "Quebec", "Western United States", "Central America"),
-            "Central America" : ("Western United States", "Eastern United States", "Venezuela"),
-            "Venezuela" : ("Central America", "Peru", "Brazil"),
-            "Peru" : ("Venezuela", "Brazil", "Argentina"),
-            "Brazil" : ("Venezuela", "Peru", "Argentina", "North Africa"),
-            "Argentina" : ("Peru", "Brazil"),
-            "Iceland" : ("Greenland", "Scandinavia", "Great Britain"),
-            "Scandinavia" : ("Iceland", "Ukraine", "Great Britain", "Northern Europe"),
-            "Ukraine" : ("Scandinavia", "Northern Europe", "Southern Europe", "Ural", "Afghanistan", "Middle East"),
-            "Great Britain" : ("Iceland", "Scandinavia", "Northern Europe", "Western Europe"),
-            "Northern Europe" : ("Scandinavia", "Ukraine", "Great Britain", "Western Europe", "Southern Europe"),
-            "Western Europe" : ("Great Britain", "Northern Europe", "Southern Europe", "North Africa"),
-            "Southern Europe" : ("Northern Europe", "Ukraine", "Western Europe", "North Africa", "Egypt", "Middle East"),
-            "North Africa" : ("Brazil", "Western Europe", "Southern Europe", "Egypt", "East Africa", "Congo"),
-            "Egypt" : ("Southern Europe", "North Africa", "East Africa", "Middle East"),
-            "East Africa" : ("North Africa", "Egypt", "Congo", "South Africa", "Madagascar", "Middle East"),
-            "Congo" : ("North Africa", "East Africa", "South Africa"),
-            "South Africa" : ("Congo", "East Africa", "Madagascar"),
-            "Madagascar" : ("East Africa", "South Africa"),
-            "Ural" : ("Ukraine", "Siberia", "Afghanistan", "China"),
-            "Siberia" : ("Ural", "Yakutsk", "Irkutsk", "Mongolia", "China"),
-            "Yakutsk" : ("Siberia", "Kamchatka", "Irkutsk"),
-            "Kamchatka" : ("Alaska", "Yakutsk", "Irkutsk", "Mongolia", "Japan"),
-            "Irkutsk" : ("Siberia", "Yakutsk", "Kamchatka", "Mongolia"),
-            "Mongolia" : ("Siberia", "Kamchatka", "Irkutsk", "Japan", "China"),
-            "Japan" : ("Kamchatka", "Mongolia"),
-            "Afghanistan" : ("Ukraine", "Ural", "China", "Middle East", "India"),
-            "China" : ("Ural", "Siberia", "Mongolia", "Afghanistan", "India", "Siam"),
-            "Middle East" : ("Ukraine", "Southern Europe", "Egypt", "East Africa", "Afghanistan", "India"),
-            "India" : ("Afghanistan", "China", "Middle East", "Siam"),
-            "Siam" : ("China", "India", "Indonesia"),
-            "Indonesia" : ("Siam", "New Guinea", "Western Australia"),
-            "New Guinea" : ("Indonesia", "Western Australia", "Eastern Australia"),
-            "Western Australia" : ("Indonesia", "New Guinea", "Eastern Australia"),
-            "Eastern Australia" : ("New Guinea", "Western Australia"),
-        },
-        "bubbles" : {
-            "Alaska" : (44, 94),
-            "North West Territory" : (125, 86),
-            "Greenland" : (268, 59),
-            "Alberta" : (112, 136),
-            "Ontario" : (155, 122),
-            "Quebec" : (206, 151),
-            "Western United States" : (109, 199),
-            "Eastern United States" : (195, 188),
-            "Central America" : (135, 253),
-            "Venezuela" : (170, 288),
-            "Peru" : (172, 371),
-            "Brazil" : (243, 375),
-            "Argentina" : (190, 457),
-            "Iceland" : (329, 114),
-            "Scandinavia" : (393, 122),
-            "Ukraine" : (457, 164),
-            "Great Britain" : (326, 179),
-            "Northern Europe" : (371, 194),
-            "Western Europe" : (340, 260),
-            "Southern Europe" : (380, 234),
-            "North Africa" : (359, 316),
-            "Egypt" : (425, 326),
-            "East Africa" : (452, 351),
-            "Congo" : (431, 421),
-            "South Africa" : (429, 498),
-            "Madagascar" : (493, 475),
-            "Ural" : (553, 145),
-            "Siberia" : (597, 101),
-            "Yakutsk" : (644, 77),
-            "Kamchatka" : (702, 82),
-            "Irkutsk" : (635, 145),
-            "Mongolia" : (648, 197),
-            "Japan" : (723, 207),
-            "Afghanistan" : (536, 214),
-            "China" : (644, 252),
-            "Middle East" : (489, 305),
-            "India" : (583, 302),
-            "Siam" : (661, 317),
-            "Indonesia" : (656, 414),
-            "New Guinea" : (733, 392),
-            "Western Australia" : (689, 452),
-            "Eastern Australia" : (762, 485)
-        }
+import json
+import os
+import pickle
+import zlib
+
+# Maps are JSON files in MAP_DIRECTORY, one per map and named after it (maps/classic.json is the classic map), with:
+#   "file"        : the path of the map's image
+#   "continents"  : a list of {"name", "bonus", "territories"}, between them covering every territory exactly once
+#   "connections" : {territory : [adjacent territories]}, going both ways; this fixes the territories' order
+#   "bubbles"     : {territory : [x, y]}, where each territory's troop count is drawn on the image
+# A map is only read the first time it's used, and what's worked out from it is cached in CACHE_DIRECTORY,
+# so that big maps cost nothing at startup and little after the first time.
+MAP_DIRECTORY = "maps"
+CACHE_DIRECTORY = os.path.join(MAP_DIRECTORY, ".cache")
+CACHE_VERSION = 3
+
+# Card codes are 16 bits, with the territory's index plus one above the two type bits (see cards.encode)
+MAX_TERRITORIES = (1 << 14) - 1
+
+
+def validate_map(data: dict, map_name: str) -> dict:
+    """Checks a map read from JSON and converts it to the shape the rest of the bot uses, with tuples for
+    connections and bubbles and a set of territories per continent. Raises ValueError if the map is broken."""
+    def error(problem: str) -> ValueError:
+        return ValueError(f"Map '{map_name}': {problem}")
+
+    if not isinstance(data, dict):
+        raise error("isn't a JSON object.")
+    missing = [key for key in ("file", "continents", "connections", "bubbles") if key not in data]
+    if missing:
+        raise error(f"missing {', '.join(missing)}.")
+    if not isinstance(data["file"], str):
+        raise error("file isn't a file name.")
+    for key in ("connections", "bubbles"):
+        if not isinstance(data[key], dict):
+            raise error(f"{key} isn't an object with a key for each territory.")
+    if not isinstance(data["continents"], list):
+        raise error("continents isn't a list.")
+
+    for name, adjacent in data["connections"].items():
+        if not isinstance(adjacent, list) or not all(isinstance(other, str) for other in adjacent):
+            raise error(f"{name}'s connections aren't a list of territory names.")
+        # Commands title-case the territories they're given, so any other name couldn't be played on
+        if name != name.title():
+            raise error(f"{name} isn't in title case (it would have to be {name.title()}).")
+    connections = {name : tuple(adjacent) for name, adjacent in data["connections"].items()}
+    if not 2 <= len(connections) <= MAX_TERRITORIES:
+        raise error(f"has {len(connections)} territories; there must be between 2 and {MAX_TERRITORIES}.")
+
+    # Connections go both ways
+    for name, adjacent in connections.items():
+        for other in adjacent:
+            if other not in connections:
+                raise error(f"{name} connects to {other}, which isn't a territory.")
+            if other == name:
+                raise error(f"{name} connects to itself.")
+            if name not in connections[other]:
+                raise error(f"{name} connects to {other}, but not the other way round.")
+
+    # Every territory has a bubble
+    for name, position in data["bubbles"].items():
+        if name not in connections:
+            raise error(f"there's a bubble for {name}, which isn't a territory.")
+        if not isinstance(position, list) or len(position) != 2 or not all(type(coordinate) is int for coordinate in position):
+            raise error(f"{name}'s bubble isn't an [x, y] pair of whole numbers.")
+    bubbles = {name : tuple(position) for name, position in data["bubbles"].items()}
+    for name in connections:
+        if name not in bubbles:
+            raise error(f"{name} has no bubble.")
+
+    # Continents cover every territory, once
+    continents = []
+    continent_of = {}
+    for i, continent in enumerate(data["continents"], 1):
+        if not isinstance(continent, dict) or not isinstance(continent.get("name"), str):
+            raise error(f"continent {i} has no name.")
+        if type(continent.get("bonus")) is not int:
+            raise error(f"continent {continent['name']} has no bonus.")
+        if not isinstance(continent.get("territories"), list) or not all(isinstance(name, str) for name in continent["territories"]):
+            raise error(f"continent {continent['name']} has no list of territory names.")
+        for name in continent["territories"]:
+            if name not in connections:
+                raise error(f"continent {continent['name']} includes {name}, which isn't a territory.")
+            if name in continent_of:
+                raise error(f"{name} is in both {continent_of[name]} and {continent['name']}.")
+            continent_of[name] = continent["name"]
+        continents.append({"name" : continent["name"], "bonus" : continent["bonus"], "territories" : set(continent["territories"])})
+    for name in connections:
+        if name not in continent_of:
+            raise error(f"{name} isn't in any continent.")
+
+    return {"file" : data["file"], "continents" : continents, "connections" : connections, "bubbles" : bubbles}
+
+
+def compile_map(map_data: dict) -> dict:
+    """Compiles a map's territories into integer form, for rules that run on every command. Territories are
+    numbered in the order of the map's connections, and sets of them are bitmasks with bit i for territory i:
+    "names" and "index" translate between names and ids, "neighbours" holds each territory's adjacent ids,
+    "adjacency" the same as bitmasks, "continents" a (bitmask, bonus) pair per continent, "all" every territory, and
+    "fingerprint" a checksum of the territories' names in order, which changes if they're renamed or reordered."""
+    names = tuple(map_data["connections"])
+    index = {name : i for i, name in enumerate(names)}
+    neighbours = tuple(tuple(index[connection] for connection in map_data["connections"][name]) for name in names)
+    return {
+        "names" : names,
+        "index" : index,
+        "neighbours" : neighbours,
+        "adjacency" : tuple(sum(1 << j for j in set(adjacent)) for adjacent in neighbours),
+        "continents" : tuple(
+            (sum(1 << index[name] for name in continent["territories"]), continent["bonus"])
+            for continent in map_data["continents"]
+        ),
+        "all" : (1 << len(names)) - 1,
+        "fingerprint" : zlib.crc32("\n".join(names).encode())
     }
-}
\ No newline at end of file
+
+
+def load_map(map_name: str) -> tuple[dict, dict]:
+    """Reads a map, validates and compiles it, and returns (map data, compiled map). Both come from the cache when
+    it's up to date with the map's file; otherwise the cache is rewritten if possible."""
+    path = os.path.join(MAP_DIRECTORY, f"{map_name}.json")
+    cache_path = os.path.join(CACHE_DIRECTORY, f"{map_name}.pickle")
+    stat = os.stat(path)
+    key = (CACHE_VERSION, stat.st_mtime_ns, stat.st_size)
+    try:
+        with open(cache_path, "rb") as file:
+            cached_key, map_data, topology = pickle.load(file)
+        if cached_key == key:
+            return map_data, topology
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        pass
+
+    with open(path, encoding="utf-8") as file:
+        map_data = validate_map(json.load(file), map_name)
+    topology = compile_map(map_data)
+    # A cache that can't be written only costs the next start a recompile
+    try:
+        os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+        temporary_path = f"{cache_path}.{os.getpid()}"
+        with open(temporary_path, "wb") as file:
+            pickle.dump((key, map_data, topology), file, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, cache_path)
+    except OSError:
+        pass
+    return map_data, topology
+
+
+_map_names = None
+
+
+def map_names() -> tuple[str]:
+    """Returns the names of the maps in MAP_DIRECTORY, without reading any of them."""
+    global _map_names
+    if _map_names is None:
+        _map_names = tuple(sorted(file_name[:-5] for file_name in os.listdir(MAP_DIRECTORY) if file_name.endswith(".json")))
+    return _map_names
+
+
+class _Maps(dict):
+    """A {map name : value} dict holding either map data or compiled maps (see compile_map), which acts as if it
+    held every map but only loads one when it's first looked up. Lookups of loaded maps are plain dict lookups."""
+
+    def __init__(self, part: int):
+        super().__init__()
+        self._part = part
+
+    def __missing__(self, map_name: str):
+        if map_name not in map_names():
+            raise KeyError(map_name)
+        map_data, topology = load_map(map_name)
+        dict.__setitem__(MAPS, map_name, map_data)
+        dict.__setitem__(TOPOLOGY, map_name, topology)
+        return (map_data, topology)[self._part]
+
+    def __contains__(self, map_name) -> bool:
+        return map_name in map_names()
+
+    def __iter__(self):
+        return iter(map_names())
+
+    def __len__(self) -> int:
+        return len(map_names())
+
+    def get(self, map_name: str, default=None):
+        return self[map_name] if map_name in self else default
+
+    def keys(self):
+        return map_names()
+
+    def values(self):
+        return [self[map_name] for map_name in self]
+
+    def items(self):
+        return [(map_name, self[map_name]) for map_name in self]
+
+
+MAPS = _Maps(0)
+TOPOLOGY = _Maps(1)
+
+
+def adjacent(map_name: str, territory_a: str, territory_b: str) -> bool:
+    """Returns whether two territories of a map border each other."""
+    topology = TOPOLOGY[map_name]
+    return bool(topology["adjacency"][topology["index"][territory_a]] >> topology["index"][territory_b] & 1)
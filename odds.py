@@ -0,0 +1,101 @@
+from array import array
+from itertools import product
+
+# Exact odds for an attack kept up until the target falls or the attacker is down to one troop (as !blitz does),
+# with the dice rules of !attack: up to three attacking dice, leaving one troop behind, two defending dice unless
+# the defender has one troop, and ties going to the defender. A battle is a Markov chain over (attacking troops,
+# defending troops) that ends when either side can't go on, so every state's odds follow from the states its rolls
+# lead to, and a table of them is built once, from the smallest battles up.
+
+# Odds are worked out for up to this many troops a side; a bigger table would take too long to build and hold
+MAX_TROOPS = 512
+
+
+def _round_outcomes(off_dice: int, def_dice: int) -> tuple[tuple[int, int, float]]:
+    """Returns the (attackers lost, defenders lost, chance) of each result of one roll with the given dice."""
+    counts = {}
+    for off_roll in product(range(1, 7), repeat=off_dice):
+        for def_roll in product(range(1, 7), repeat=def_dice):
+            pairs = zip(sorted(off_roll, reverse=True), sorted(def_roll, reverse=True))
+            def_lost = sum(off_die > def_die for off_die, def_die in pairs)
+            lost = (min(off_dice, def_dice) - def_lost, def_lost)
+            counts[lost] = counts.get(lost, 0) + 1
+    total = 6 ** (off_dice + def_dice)
+    return tuple((off_lost, def_lost, count / total) for (off_lost, def_lost), count in sorted(counts.items()))
+
+
+_ROUNDS = {(off_dice, def_dice) : _round_outcomes(off_dice, def_dice) for off_dice in (1, 2, 3) for def_dice in (1, 2)}
+
+# The table: for each state, at index defending troops * (_size + 1) + attacking troops, the chance of winning and
+# the expected troops each side has left at the end. build() makes it whole up front; otherwise it's rebuilt twice
+# as big whenever a bigger battle comes up.
+_size = 0
+_win, _attackers_left, _defenders_left = array("d"), array("d"), array("d")
+
+
+def _build(size: int) -> None:
+    """Builds the table for battles of up to size troops a side."""
+    global _size, _win, _attackers_left, _defenders_left
+    width = size + 1
+    win, attackers_left, defenders_left = (array("d", bytes(8 * width * width)) for _ in range(3))
+    for defenders in range(width):
+        for attackers in range(1, width):
+            i = defenders * width + attackers
+            if defenders == 0:
+                win[i], attackers_left[i] = 1.0, attackers
+                continue
+            if attackers == 1:
+                attackers_left[i], defenders_left[i] = 1, defenders
+                continue
+            # Each roll costs the two sides at least one troop between them, so the states it leads to are done
+            w = a = d = 0.0
+            for off_lost, def_lost, chance in _ROUNDS[min(3, attackers - 1), min(2, defenders)]:
+                j = i - def_lost * width - off_lost
+                w += chance * win[j]
+                a += chance * attackers_left[j]
+                d += chance * defenders_left[j]
+            win[i], attackers_left[i], defenders_left[i] = w, a, d
+    _size, _win, _attackers_left, _defenders_left = size, win, attackers_left, defenders_left
+
+
+def build() -> None:
+    """Builds the whole table, for battles of up to MAX_TROOPS troops a side, so no lookup has to build it later."""
+    _build(MAX_TROOPS)
+
+
+def odds(attackers: int, defenders: int) -> tuple[float, float, float]:
+    """Returns the chance that an attacking territory with the given troops conquers one with the given defenders,
+    and the troops each is expected to have left once one side is spent (counting the troop that stays behind).
+    Raises a ValueError for more than MAX_TROOPS troops a side."""
+    if attackers < 1 or defenders < 0:
+        raise ValueError("Territories have at least one troop.")
+    if max(attackers, defenders) > MAX_TROOPS:
+        raise ValueError(f"Odds only go up to {MAX_TROOPS} troops a side.")
+    if max(attackers, defenders) > _size:
+        size = 64
+        while size < max(attackers, defenders):
+            size *= 2
+        _build(min(size, MAX_TROOPS))
+    i = defenders * (_size + 1) + attackers
+    return _win[i], _attackers_left[i], _defenders_left[i]
+
+
+if __name__ == "__main__":
+    # Benchmark: building the table and looking odds up in it, next to a Monte Carlo estimate as a sanity check
+    from timeit import timeit
+    import random as r
+    print(f"build {MAX_TROOPS}: {timeit(lambda: _build(MAX_TROOPS), number=1):.2f} s")
+    runs = 100000
+    print(f"lookup: {timeit(lambda: odds(r.randint(2, MAX_TROOPS), r.randint(1, MAX_TROOPS)), number=runs) / runs * 1e6:.2f} us")
+
+    def simulate(attackers: int, defenders: int) -> bool:
+        while attackers > 1 and defenders:
+            off_dice = sorted((r.randint(1, 6) for _ in range(min(3, attackers - 1))), reverse=True)
+            def_dice = sorted((r.randint(1, 6) for _ in range(min(2, defenders))), reverse=True)
+            for off_die, def_die in zip(off_dice, def_dice):
+                if off_die > def_die: defenders -= 1
+                else: attackers -= 1
+        return defenders == 0
+    for attackers, defenders in ((3, 2), (10, 10), (30, 25)):
+        estimate = sum(simulate(attackers, defenders) for _ in range(20000)) / 20000
+        print(f"{attackers} vs {defenders}: exact {odds(attackers, defenders)[0]:.4f}, simulated {estimate:.4f}")
@@ -0,0 +1,78 @@
+import asyncio
+import display
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+# Maps are drawn in worker processes, so PIL never holds up the event loop and games render on every core.
+# Each worker is its own single-process pool: a game's renders always go to the same worker, where its last
+# image is waiting to be touched up (see display.render_board).
+WORKERS = os.cpu_count() or 1
+
+# How many renders may be queued or running at once; past that, callers wait their turn
+MAX_PENDING = 4 * WORKERS
+
+# Spawned rather than forked, so workers don't inherit the bot's threads and connections
+_context = multiprocessing.get_context("spawn")
+_workers = [None] * WORKERS
+_pending = asyncio.Semaphore(MAX_PENDING)
+
+
+def _worker(i: int) -> ProcessPoolExecutor:
+    """Returns the i-th worker, starting it if it isn't running."""
+    if _workers[i] is None:
+        _workers[i] = ProcessPoolExecutor(max_workers=1, mp_context=_context, initializer=display.preload_maps)
+    return _workers[i]
+
+
+def start() -> None:
+    """Starts every worker ahead of time, so that they have their map images loaded before the first render.
+    Pools only spawn their process once there's work for it, so each is handed a job that does nothing."""
+    for i in range(WORKERS):
+        _worker(i).submit(os.getpid)
+
+
+async def render_board(board: tuple, key = None) -> bytes:
+    """Returns the encoded image bytes of a display.board_state, rendered by a worker unless this process rendered it recently."""
+    data = display.cached_render(board)
+    if data is not None:
+        return data
+
+    i = hash(key) % WORKERS
+    async with _pending:
+        loop = asyncio.get_running_loop()
+        try:
+            data = await loop.run_in_executor(_worker(i), display.render_board, board, key)
+        except BrokenProcessPool:
+            # The worker died; start a new one and give it one more go
+            _workers[i] = None
+            data = await loop.run_in_executor(_worker(i), display.render_board, board, key)
+    display.cache_render(board, data)
+    return data
+
+
+async def draw_map(game: dict) -> BytesIO:
+    """Awaitable version of display.draw_map."""
+    return BytesIO(await render_board(display.board_state(game), tuple(game["turn_order"])))
+
+
+async def draw_replay(boards: list[tuple]) -> BytesIO:
+    """Awaitable version of display.draw_replay. Replays are spread across the workers by their first board."""
+    i = hash(boards[0]) % WORKERS
+    async with _pending:
+        loop = asyncio.get_running_loop()
+        try:
+            data = await loop.run_in_executor(_worker(i), display.draw_replay, boards)
+        except BrokenProcessPool:
+            _workers[i] = None
+            data = await loop.run_in_executor(_worker(i), display.draw_replay, boards)
+    return BytesIO(data)
+
+
+def shutdown() -> None:
+    """Stops every worker."""
+    for worker in _workers:
+        if worker is not None:
+            worker.shutdown()
@@ -0,0 +1,123 @@
+from game_state import GameState
+from maps import MAPS
+from strategies import STRATEGIES, play_pregame_turn
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import random as r
+import sys
+import time
+
+# Plays whole games between scripted strategies (see strategies.py) on every core, streaming one line of
+# results per game to a CSV or JSONL file, e.g. to check what a rule change does to games, or how fast the
+# engine runs:
+#   python simulate.py --games 1000 --strategies aggressive,cautious,random --output results.jsonl
+
+# Games still going after this many turns are called off without a winner
+MAX_TURNS = 2000
+
+FIELDS = ("game", "seed", "map", "randomfill", "strategies", "winner_seat", "winner_strategy", "turns", "trades", "eliminations", "seconds")
+
+
+def play_game(game: int, seed: int, strategies: tuple[str], map_name: str = "classic", randomfill: bool = False) -> dict:
+    """Plays a game with a strategy per seat, in turn order, and returns a row of results."""
+    started = time.perf_counter()
+    r.seed(seed)
+    # Player ids are seat numbers, so that the engine's shuffle of them can be undone
+    state = GameState.new([str(seat) for seat in range(len(strategies))], map_name, randomfill)
+    seat_strategies = [strategies[int(player_id)] for player_id in state.player_ids]
+    turns, winner, eliminations = 0, None, []
+
+    while turns < MAX_TURNS:
+        seat = state.active_player
+        if state.in_pregame:
+            play_pregame_turn(state, seat)
+            continue
+        turns += 1
+        eliminated = len(state.eliminated_players)
+        if STRATEGIES[seat_strategies[seat]](state, seat):
+            winner = seat
+            break
+        eliminations += [f"{seat_strategies[loser]}@{turns}" for loser in state.eliminated_players[eliminated:]]
+
+    return {
+        "game" : game,
+        "seed" : seed,
+        "map" : map_name,
+        "randomfill" : randomfill,
+        "strategies" : "/".join(seat_strategies),
+        "winner_seat" : winner,
+        "winner_strategy" : None if winner is None else seat_strategies[winner],
+        "turns" : turns,
+        "trades" : state.trade_count,
+        "eliminations" : " ".join(eliminations),
+        "seconds" : round(time.perf_counter() - started, 4)
+    }
+
+
+def _play(args: tuple) -> dict:
+    """play_game for Pool.imap_unordered."""
+    return play_game(*args)
+
+
+def simulate(games: int, strategies: list[str], output, map_name: str = "classic", randomfill: bool = False,
+             workers: int = None, seed: int = None, rotate: bool = True) -> dict:
+    """Plays games across a pool of worker processes, writing each game's results to output (an open file, as
+    JSONL, or a csv.DictWriter) as soon as the game is over. With rotate, the strategies' seats move round by one
+    each game. Returns the totals: "games", "seconds", "games_per_second" and "wins" by strategy."""
+    workers = workers or os.cpu_count() or 1
+    base_seed = seed if seed is not None else r.randrange(2**32)
+    tasks = [
+        (
+            game, base_seed + game,
+            tuple(strategies[(seat + (game if rotate else 0)) % len(strategies)] for seat in range(len(strategies))),
+            map_name, randomfill
+        )
+        for game in range(games)
+    ]
+
+    wins = {strategy : 0 for strategy in strategies}
+    started = time.perf_counter()
+    with multiprocessing.get_context("spawn").Pool(workers) as pool:
+        for row in pool.imap_unordered(_play, tasks, chunksize=max(1, games // (workers * 8))):
+            if isinstance(output, csv.DictWriter):
+                output.writerow(row)
+            else:
+                output.write(json.dumps(row) + "\n")
+            if row["winner_strategy"] is not None:
+                wins[row["winner_strategy"]] += 1
+    seconds = time.perf_counter() - started
+    return {"games" : games, "seconds" : seconds, "games_per_second" : games / seconds, "workers" : workers, "wins" : wins}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plays games of Risk between scripted strategies.")
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--strategies", default="aggressive,cautious,random", help=f"one per player, from: {', '.join(STRATEGIES)}")
+    parser.add_argument("--map", default="classic", choices=list(MAPS))
+    parser.add_argument("--randomfill", action="store_true", help="deal territories out at random instead of a pregame")
+    parser.add_argument("--workers", type=int, help="processes to play on (default: one per core)")
+    parser.add_argument("--seed", type=int, help="seed of the first game; game i uses seed + i")
+    parser.add_argument("--fixed-seats", action="store_true", help="don't rotate the strategies' seats from game to game")
+    parser.add_argument("--output", default="simulation.jsonl", help="results file; .csv for CSV, anything else for JSONL")
+    args = parser.parse_args()
+
+    strategies = args.strategies.split(",")
+    if not 2 <= len(strategies) <= 6 or any(strategy not in STRATEGIES for strategy in strategies):
+        parser.error(f"--strategies takes 2 to 6 of: {', '.join(STRATEGIES)}")
+
+    with open(args.output, "w", newline="") as file:
+        output = file
+        if args.output.endswith(".csv"):
+            output = csv.DictWriter(file, FIELDS)
+            output.writeheader()
+        totals = simulate(args.games, strategies, output, args.map, args.randomfill, args.workers, args.seed, not args.fixed_seats)
+
+    print(
+        f"{totals['games']} games in {totals['seconds']:.1f} s: {totals['games_per_second']:.1f} games/s, "
+        f"{totals['games_per_second'] / totals['workers']:.1f} per worker", file=sys.stderr
+    )
+    for strategy, count in totals["wins"].items():
+        print(f"{strategy:>12}: {count} wins", file=sys.stderr)
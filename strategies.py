@@ -0,0 +1,142 @@
+from cards import best_set, encode as encode_card
+from engine import roll_dice
+from game_state import GameState
+from maps import TOPOLOGY
+import random as r
+
+# Scripted players for games played without the bot (see simulate.py). Each strategy is a function that plays one
+# whole turn of a GameState for a seat, making only moves that the bot would accept from a person, and returns
+# whether that won the game. Pregame deployments are the same for every strategy (see play_pregame_turn).
+
+
+def _trade(state: GameState, seat: int, forced_only: bool) -> None:
+    """Trades in the best set of cards, over and over, as long as there's a set and either the player has too many
+    cards or forced_only is off."""
+    index = TOPOLOGY[state.map]["index"]
+    while len(state.cards[seat]) >= 3 and (state.turn_stage == 0 or not forced_only):
+        selected = best_set(state.hand(seat), [], state.owned(seat))
+        if selected is None:
+            break
+        state.trade(seat, [encode_card(card, index) for card in selected])
+
+
+def _attack_until_done(state: GameState, seat: int, target: int, attacker: int, keep_going) -> dict:
+    """Attacks with as many dice as allowed for as long as keep_going(attacking troops, defending troops) says so,
+    moving every spare troop forward after a conquest. Returns the last attack's result, or None if there wasn't one."""
+    result = None
+    while state.owners[target] != seat and state.troops[attacker] > 1 and keep_going(state.troops[attacker], state.troops[target]):
+        army_size = min(3, state.troops[attacker] - 1)
+        off_dice, def_dice = roll_dice(army_size, state.troops[target])
+        result = state.attack(seat, target, attacker, army_size, off_dice, def_dice)
+        if result["victory"]:
+            return result
+        if result["conquered"] and state.last_attack is not None:
+            state.advance(state.troops[attacker] - 1)
+    return result
+
+
+def _fortify(state: GameState, seat: int) -> None:
+    """Moves the biggest army that has no enemies around it to the frontline territory it can reach with the
+    fewest troops, and ends the turn either way."""
+    territories = state.territories(seat)
+    interior = [i for i in territories if state.troops[i] > 1 and not state.enemies(seat, i)]
+    if interior:
+        start = max(interior, key=lambda i: state.troops[i])
+        frontline = [i for i in territories if state.enemies(seat, i) and state.has_path(seat, start, i)]
+        if frontline:
+            state.move(start, min(frontline, key=lambda i: state.troops[i]), state.troops[start] - 1)
+            return
+    state.end_turn()
+
+
+def play_pregame_turn(state: GameState, seat: int) -> None:
+    """Deploys one troop: on the unclaimed territory with the most of the player's territories around it while
+    there are any, and then on the player's territory with the most enemy troops around it."""
+    neighbours = TOPOLOGY[state.map]["neighbours"]
+    if state.unclaimed_territories:
+        choices = [i for i in range(len(state.owners)) if state.owners[i] < 0]
+        territory = max(choices, key=lambda i: (sum(state.owners[j] == seat for j in neighbours[i]), r.random()))
+    else:
+        territory = max(
+            state.territories(seat),
+            key=lambda i: (sum(state.troops[j] for j in state.enemies(seat, i)), r.random())
+        )
+    state.deploy(seat, territory, 1)
+
+
+def random_turn(state: GameState, seat: int) -> bool:
+    """Trades whenever it can, deploys troops one at a time anywhere, and makes random attacks with no thought for
+    the odds."""
+    _trade(state, seat, forced_only=False)
+    territories = state.territories(seat)
+    while state.deployable_troops[seat]:
+        state.deploy(seat, r.choice(territories), 1)
+
+    for _ in range(r.randint(0, 6)):
+        attacks = [
+            (target, attacker) for attacker in state.territories(seat) if state.troops[attacker] > 1
+            for target in state.enemies(seat, attacker)
+        ]
+        if not attacks:
+            break
+        target, attacker = r.choice(attacks)
+        result = _attack_until_done(state, seat, target, attacker, lambda off, defending: r.random() < 0.8)
+        if result is not None and result["victory"]:
+            return True
+    if r.random() < 0.5:
+        _fortify(state, seat)
+    else:
+        state.end_turn()
+    return False
+
+
+def aggressive_turn(state: GameState, seat: int) -> bool:
+    """Trades whenever it can, stacks every troop on the frontline territory facing the weakest neighbour, and
+    attacks wherever it has more troops than the defender."""
+    _trade(state, seat, forced_only=False)
+    frontline = [i for i in state.territories(seat) if state.enemies(seat, i)]
+    territory = max(frontline, key=lambda i: state.troops[i] - min(state.troops[j] for j in state.enemies(seat, i)))
+    state.deploy(seat, territory, state.deployable_troops[seat])
+
+    while True:
+        attacks = [
+            (state.troops[attacker] - state.troops[target], target, attacker)
+            for attacker in state.territories(seat) if state.troops[attacker] > 2
+            for target in state.enemies(seat, attacker) if state.troops[attacker] > state.troops[target] + 1
+        ]
+        if not attacks:
+            break
+        _, target, attacker = max(attacks)
+        result = _attack_until_done(state, seat, target, attacker, lambda off, defending: off > 1)
+        if result["victory"]:
+            return True
+    _fortify(state, seat)
+    return False
+
+
+def cautious_turn(state: GameState, seat: int) -> bool:
+    """Only trades when it has to, shores up its weakest frontline territories, and only attacks with at least
+    twice the defender's troops, stopping once that's no longer so."""
+    _trade(state, seat, forced_only=True)
+    frontline = [i for i in state.territories(seat) if state.enemies(seat, i)]
+    while state.deployable_troops[seat]:
+        territory = min(frontline, key=lambda i: state.troops[i])
+        state.deploy(seat, territory, 1)
+
+    while True:
+        attacks = [
+            (target, attacker)
+            for attacker in state.territories(seat)
+            for target in state.enemies(seat, attacker) if state.troops[attacker] >= 2 * state.troops[target] + 2
+        ]
+        if not attacks:
+            break
+        target, attacker = r.choice(attacks)
+        result = _attack_until_done(state, seat, target, attacker, lambda off, defending: off >= 2 * defending + 2)
+        if result["victory"]:
+            return True
+    _fortify(state, seat)
+    return False
+
+
+STRATEGIES = {"random" : random_turn, "aggressive" : aggressive_turn, "cautious" : cautious_turn}